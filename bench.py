@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import resource
+import time
+from collections import OrderedDict
+import numpy as np
+import tools
+import newshape
+from model import VoxelModel
+from dataset import ShapeDataset
+
+'''benchmarks for the inference and meshing pipeline, run offline on random weights and cppn shapes'''
+
+def random_model(seed=0):
+    '''Model with the trained network's layer sizes. Dense evaluation time does not
+       depend on the weights, but its shapes are almost empty, so they are no use for
+       timing meshing'''
+    rng = np.random.RandomState(seed)
+    weights = [rng.uniform(-2, 2, size=s) for s in ((5, 10), (10, 10), (10, 1))]
+    biases = [rng.uniform(-1, 1, size=10) for _ in range(2)]
+    return VoxelModel(weights, biases)
+
+def bench_projection(size, steps):
+    '''per frame latent traversal time without and with the cached coordinate projection'''
+    coords = tools.generate_coords(size)
+    latents = np.linspace(0, 1, steps)
+    model = random_model()
+    start = time.time()
+    for latent in latents:
+        model.predict(coords, latent)
+    uncached = (time.time() - start) / steps
+
+    start = time.time()
+    model.project(coords, size)
+    setup = time.time() - start
+    start = time.time()
+    for latent in latents:
+        model.predict(coords, latent, size=size)
+    cached = (time.time() - start) / steps
+    print('projection cache {}^3, {} frames: uncached {:0.3f}s/frame | cached {:0.3f}s/frame '
+          '(+{:0.3f}s once) | {:0.2f}x'.format(size, steps, uncached, cached, setup, uncached / cached))
+
+def bench_adaptive(size, latent=0.5):
+    '''network evaluations, time and mismatch of adaptive against dense evaluation'''
+    random_model().compare_adaptive(tools.generate_coords(size), latent, size)
+
+def reset_peak_rss():
+    '''reset the kernel's peak RSS mark of this process to its current RSS, linux only'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def rss_status(field):
+    '''VmRSS / VmHWM of this process in bytes, None where /proc is not available'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def measure(fn, repeat=1):
+    '''Best wall time of repeat calls of fn and the peak RSS while they ran. peak_delta
+       is the peak above the RSS at the start, only when the peak mark can be reset'''
+    reset = reset_peak_rss()
+    start_rss = rss_status('VmRSS')
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    peak = rss_status('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kB on linux and the peak of the whole process
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'time': min(times), 'peak_rss': peak,
+            'peak_delta': peak - start_rss if reset and start_rss is not None else None}
+
+def train_epoch(data, batch_size=1000, lr=0.001):
+    '''One epoch of the net.py training graph over data, None when tensorflow is missing'''
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return None
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, 5])
+        y = tf.placeholder(tf.float32, [None, 1])
+        w1 = tf.Variable(tf.random_uniform([5, 10]))
+        w2 = tf.Variable(tf.random_uniform([10, 10]))
+        w3 = tf.Variable(tf.random_uniform([10, 1]))
+        b1 = tf.Variable(tf.random_uniform([10]))
+        b2 = tf.Variable(tf.random_uniform([10]))
+        hidden1 = tf.tanh(tf.matmul(x, w1) + b1)
+        hidden2 = tf.tanh(tf.matmul(hidden1, w2) + b2)
+        output = tf.nn.sigmoid(tf.matmul(hidden2, w3))
+        train = tf.train.GradientDescentOptimizer(lr).minimize(tf.reduce_sum(tf.square(y - output)))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # the graph setup is not part of the epoch
+            start = time.perf_counter()
+            for batch_x, batch_y in data.batches(batch_size):
+                sess.run(train, feed_dict={x: batch_x, y: batch_y})
+            return time.perf_counter() - start
+
+def suite_stages(sizes, train_size=32, shapes=3):
+    '''(name, fn) for every benchmarked pipeline stage, fns return None when skipped'''
+    model = random_model()
+    stages = []
+    for size in sizes:
+        def load(size=size):
+            tools.COORD_CACHE.clear()
+            # the dataset is memory mapped, reading it is part of loading
+            return float(np.sum(tools.load_coord_dataset(size)))
+        stages.append(('generate_coords_{}'.format(size), lambda size=size: tools.generate_coords(size)))
+        stages.append(('load_coord_dataset_{}'.format(size), load))
+
+    train_shapes = [voxels for _, voxels in newshape.generate_shapes(train_size, shapes, seed=0)]
+    data = ShapeDataset(tools.load_coord_dataset(train_size), np.linspace(0, 1, shapes), train_shapes)
+    stages.append(('shape_generation_{}'.format(train_size),
+                   lambda: list(newshape.generate_shapes(train_size, shapes, seed=0))))
+    stages.append(('epoch_batches_{}'.format(train_size), lambda: sum(len(x) for x, y in data.batches(1000))))
+    stages.append(('train_epoch_{}'.format(train_size), lambda: train_epoch(data)))
+
+    for size in sizes:
+        coords = tools.load_coord_dataset(size)
+        # a single latent is evaluated without the projection cache, every repeat is cold
+        stages.append(('inference_{}'.format(size), lambda coords=coords, size=size: model.voxels(coords, 0.5, size)))
+        # meshing and serialization are timed on a cppn shape, which has realistic surfaces
+        voxels = newshape.shape_batch(size, [0])[0]
+        mesh = tools.mesh_arrays(voxels)
+        stages.append(('mesh_{}'.format(size), lambda voxels=voxels: tools.mesh_arrays(voxels)))
+        stages.append(('mesh_greedy_{}'.format(size), lambda voxels=voxels: tools.mesh_arrays(voxels, True)))
+        stages.append(('serialize_html_{}'.format(size), lambda mesh=mesh: tools.write_viewer(
+                       tools.VIEWER_HTML, [mesh], 'template_bench.html', x=0, y=0, z=0)))
+        stages.append(('serialize_json_{}'.format(size),
+                       lambda mesh=mesh: json.dumps(tools.encode_meshes([mesh], 'json'))))
+    return stages
+
+def run_suite(sizes, repeat=1, only=None):
+    '''Measure every stage, returns the results dict written as json'''
+    results = OrderedDict()
+    for name, fn in suite_stages(sizes):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        skipped = []
+        stats = measure(lambda: skipped.append(fn() is None), repeat)
+        if skipped and all(skipped) and name.startswith('train_epoch'):
+            print('--> BENCH {:<24} skipped, tensorflow is not installed'.format(name))
+            continue
+        results[name] = stats
+        print('--> BENCH {:<24} {:>9.4f}s  peak rss {:>8.1f} MB'.format(name, stats['time'], stats['peak_rss'] / 2 ** 20))
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'platform': platform.platform(), 'cpus': os.cpu_count(),
+                     'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'sizes': list(sizes), 'repeat': repeat},
+            'stages': results}
+
+def compare_baseline(results, baseline, threshold=0.2, min_time=0.005):
+    '''Print the time ratio of every stage against a baseline results dict. A stage
+       regresses when it is more than threshold slower and min_time seconds slower.
+       Returns the regressed stage names'''
+    regressed = []
+    for name, stats in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        ratio = stats['time'] / max(base['time'], 1e-9)
+        slower = stats['time'] - base['time']
+        flag = ratio > 1 + threshold and slower > min_time
+        if flag:
+            regressed.append(name)
+        print('--> BASELINE {:<24} {:>9.4f}s vs {:>9.4f}s  {:>5.2f}x{}'.format(
+              name, stats['time'], base['time'], ratio, '  REGRESSION' if flag else ''))
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--op', type=str, default='projection',
+                        help='benchmark to run: projection | adaptive | suite')
+    parser.add_argument('--size', type=int, default=128,
+                        help='Voxel dimensions cubed')
+    parser.add_argument('--steps', type=int, default=5,
+                        help='latent steps per benchmark')
+    parser.add_argument('--sizes', type=str, default='32,64,128,256',
+                        help='suite grid sizes, comma separated')
+    parser.add_argument('--stages', type=str, default=None,
+                        help='suite stage name prefixes to run, comma separated, default all')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='suite runs per stage, the best time is kept')
+    parser.add_argument('--out', type=str, default='bench.json',
+                        help='suite results json path')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='suite results json to compare against, exits 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction a stage may be slower than the baseline')
+    args = parser.parse_args()
+    if args.op == 'projection':
+        bench_projection(args.size, args.steps)
+    elif args.op == 'adaptive':
+        bench_adaptive(args.size)
+    elif args.op == 'suite':
+        sizes = [int(s) for s in args.sizes.split(',')]
+        only = args.stages.split(',') if args.stages else None
+        results = run_suite(sizes, args.repeat, only)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('--> WROTE', args.out)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressed = compare_baseline(results, json.load(f), args.threshold)
+            if regressed:
+                print('--> REGRESSED: {}'.format(', '.join(regressed)))
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
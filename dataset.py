@@ -0,0 +1,144 @@
+import numpy as np
+import tools
+from store import ShapeStore
+
+'''Training data for net.py: one shared coordinate grid, bit packed targets and
+   minibatches assembled on the fly from (voxel index, shape index) pairs'''
+
+def read_bits(bits, voxels, shapes):
+    '''bit values of (voxel, shape) index arrays in a (shape_amount, ceil(vol / 8)) packbits array'''
+    byte = bits[shapes, voxels >> 3]
+    return (byte >> (7 - (voxels & 7)).astype(np.uint8)) & 1
+
+class ShapeDataset:
+    '''Keeps the (vol, 4) coordinate grid once, a latent value per shape and the shape
+       occupancies as packed bits, instead of a (vol, 5) float input and a (vol, 1)
+       float64 target copy per shape.
+
+       data = ShapeDataset.load(32, latent_vec)
+       for x, y in data.batches(1000, shuffle=True):
+           sess.run(train, feed_dict={x_in: x, y_in: y})'''
+
+    def __init__(self, coords, latents, shapes=None, bits=None):
+        self.coords = np.asarray(coords, dtype=np.float32)
+        self.latents = np.asarray(latents, dtype=np.float32).reshape(-1)
+        self.vol = len(self.coords)
+        self.shape_amount = len(self.latents)
+        # (shape_amount, ceil(vol / 8)) packed occupancy bits, given directly or packed from shapes
+        if bits is None:
+            bits = np.stack([np.packbits(np.asarray(s).reshape(-1) > 0.5) for s in shapes])
+        self.bits = np.ascontiguousarray(bits, dtype=np.uint8)
+        self.size = int(round(self.vol ** (1 / 3)))
+        # surface voxels, built on first use by the surface sampler
+        self.surface_bits = None
+        self.surface_pairs = None
+
+    @classmethod
+    def load(cls, size, latent_vec, dirname='shapes'):
+        '''coordinate dataset of size and every shape in the shape store, in order.
+           The store keeps the same packed bits, so they are copied without unpacking'''
+        bits = ShapeStore.open(dirname).packed_array(size)
+        return cls(tools.load_coord_dataset(size), latent_vec[:len(bits)], bits=bits)
+
+    def __len__(self):
+        return self.vol * self.shape_amount
+
+    def targets(self, voxels, shapes):
+        '''(n, 1) float32 occupancy for voxel and shape index arrays, read from the packed bits'''
+        return read_bits(self.bits, voxels, shapes).astype(np.float32).reshape(-1, 1)
+
+    def inputs(self, voxels, shapes):
+        '''(n, 5) float32 network inputs [x, y, z, radius, latent] for index arrays'''
+        x = np.empty((len(voxels), 5), dtype=np.float32)
+        x[:, :4] = self.coords[voxels]
+        x[:, 4] = self.latents[shapes]
+        return x
+
+    def shape_data(self, shape, start=0, stop=None, voxels=None):
+        '''inputs and targets for a contiguous voxel range of one shape, or for the
+           given voxel index array'''
+        if voxels is None:
+            voxels = np.arange(start, self.vol if stop is None else min(stop, self.vol))
+        shapes = np.full(len(voxels), shape)
+        return self.inputs(voxels, shapes), self.targets(voxels, shapes)
+
+    def monitor_voxels(self, amount, seed=0):
+        '''Fixed random voxel subset per shape for cheap loss estimates, (shape_amount, n).
+           Uses its own random state so the training draws are not affected'''
+        if amount >= self.vol:
+            return np.tile(np.arange(self.vol), (self.shape_amount, 1))
+        rng = np.random.RandomState(seed)
+        return np.stack([np.sort(rng.choice(self.vol, amount, replace=False)) for _ in range(self.shape_amount)])
+
+    def surface(self):
+        '''Pair ids shape * vol + voxel of every voxel whose occupancy differs from one of
+           its 6 neighbours, i.e. the voxels on both sides of a shape's surface'''
+        if self.surface_pairs is None:
+            masks = []
+            for shape in range(self.shape_amount):
+                grid = np.unpackbits(self.bits[shape], count=self.vol).reshape((self.size,) * 3)
+                edge = np.zeros(grid.shape, dtype=bool)
+                for axis in range(3):
+                    diff = np.diff(grid, axis=axis) != 0
+                    lower = [slice(None)] * 3
+                    upper = [slice(None)] * 3
+                    lower[axis] = slice(None, -1)
+                    upper[axis] = slice(1, None)
+                    edge[tuple(lower)] |= diff
+                    edge[tuple(upper)] |= diff
+                masks.append(np.packbits(edge.reshape(-1)))
+            self.surface_bits = np.stack(masks)
+            self.surface_pairs = np.concatenate([shape * self.vol + np.flatnonzero(
+                np.unpackbits(masks[shape], count=self.vol)) for shape in range(self.shape_amount)])
+        return self.surface_pairs
+
+    def surface_epoch(self, rest_ratio=0.1, rng=np.random):
+        '''Shuffled pair ids for one importance sampled epoch: every surface voxel of
+           every shape plus about rest_ratio of the remaining voxels, drawn at random'''
+        surface = self.surface()
+        rest = rng.randint(0, len(self), size=int(rest_ratio * len(self)))
+        rest = rest[read_bits(self.surface_bits, rest % self.vol, rest // self.vol) == 0]
+        pairs = np.concatenate([surface, rest])
+        rng.shuffle(pairs)
+        return pairs
+
+    def batches(self, batch_size, shuffle=False, rng=np.random, pairs=None):
+        '''Yield (x, y) minibatches covering every (voxel, shape) pair once.
+           Without shuffle the order matches the original loop: each voxel slice of
+           batch_size for every shape in turn. With shuffle, batches mix voxels and
+           shapes drawn in a random order. pairs overrides the samples with an array
+           of pair ids shape * vol + voxel, e.g. from surface_epoch'''
+        if pairs is not None:
+            order = pairs
+        elif not shuffle:
+            for start in range(0, self.vol, batch_size):
+                for shape in range(self.shape_amount):
+                    yield self.shape_data(shape, start, start + batch_size)
+            return
+        else:
+            order = rng.permutation(len(self))
+        for start in range(0, len(order), batch_size):
+            pairs = order[start:start + batch_size]
+            voxels, shapes = pairs % self.vol, pairs // self.vol
+            yield self.inputs(voxels, shapes), self.targets(voxels, shapes)
+
+    def stacked_batches(self, batch_size, steps, rng=np.random, pairs=None):
+        '''Yield (x, y) groups of up to steps shuffled minibatches stacked along a leading
+           axis, (steps, batch_size, 5) and (steps, batch_size, 1), for training several
+           steps per session call. Minibatches come in the order of batches(shuffle=True),
+           a last partial minibatch comes as a group of its own after the others'''
+        group_x, group_y = [], []
+        for x, y in self.batches(batch_size, shuffle=True, rng=rng, pairs=pairs):
+            if len(x) < batch_size:
+                if group_x:
+                    yield np.stack(group_x), np.stack(group_y)
+                    group_x, group_y = [], []
+                yield x[None], y[None]
+                continue
+            group_x.append(x)
+            group_y.append(y)
+            if len(group_x) == steps:
+                yield np.stack(group_x), np.stack(group_y)
+                group_x, group_y = [], []
+        if group_x:
+            yield np.stack(group_x), np.stack(group_y)
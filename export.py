@@ -0,0 +1,165 @@
+import os
+import json
+import shutil
+import struct
+import tempfile
+import time
+import numpy as np
+import tools
+import instrument
+
+'''Headless mesh export to binary PLY, binary STL, binary glTF (GLB) and ASCII OBJ.
+   Meshes are written chunk by chunk from tools.iter_mesh_chunks, in voxel units with
+   the viewer's y up axis order, so a large mesh never exists in memory at once.
+   Smooth iso-surfaces of probability grids are written as one chunk'''
+
+FORMATS = ('ply', 'stl', 'glb', 'obj')
+
+def chunk_positions(verts):
+    '''float32 positions of mesh verts in voxel units and viewer axis order'''
+    return np.ascontiguousarray(np.asarray(verts, dtype=np.float32)[:, [1, 2, 0]] / 2)
+
+def chunk_triangles(faces):
+    '''uint32 (2n, 3) triangles of (n, 4) quads, split like the viewer index'''
+    return np.ascontiguousarray(np.asarray(faces, dtype=np.uint32)[:, [0, 1, 2, 2, 3, 0]].reshape(-1, 3))
+
+def numbered_path(path, num):
+    '''path with a shape or frame number put in front of the extension'''
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, num, ext)
+
+def write_ply(f, chunks):
+    '''binary little endian PLY with quad faces, the body is spooled to a temporary
+       file while counting so the header can carry the totals'''
+    nverts = nfaces = 0
+    with tempfile.TemporaryFile() as verts_file, tempfile.TemporaryFile() as faces_file:
+        for verts, faces in chunks:
+            verts_file.write(chunk_positions(verts).astype('<f4').tobytes())
+            # list property: uchar count 4 followed by 4 int indices
+            rows = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', 4)])
+            rows['n'] = 4
+            rows['v'] = np.asarray(faces, dtype=np.int64) + nverts
+            faces_file.write(rows.tobytes())
+            nverts += len(verts)
+            nfaces += len(faces)
+        f.write('ply\nformat binary_little_endian 1.0\ncomment voxCPPN\n'
+                'element vertex {}\nproperty float x\nproperty float y\nproperty float z\n'
+                'element face {}\nproperty list uchar int vertex_indices\nend_header\n'.format(
+                nverts, nfaces).encode('ascii'))
+        for body in (verts_file, faces_file):
+            body.seek(0)
+            shutil.copyfileobj(body, f)
+    return nverts, nfaces
+
+def write_stl(f, chunks):
+    '''binary STL, the triangle count in the header is filled in at the end'''
+    f.write(b'voxCPPN'.ljust(80, b' '))
+    f.write(struct.pack('<I', 0))
+    nverts = ntris = 0
+    record = np.dtype([('normal', '<f4', 3), ('tri', '<f4', (3, 3)), ('attr', '<u2')])
+    for verts, faces in chunks:
+        tri = chunk_positions(verts)[chunk_triangles(faces)]
+        normal = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        normal /= np.maximum(np.linalg.norm(normal, axis=1, keepdims=True), 1e-12)
+        rows = np.zeros(len(tri), dtype=record)
+        rows['normal'] = normal
+        rows['tri'] = tri
+        f.write(rows.tobytes())
+        nverts += len(verts)
+        ntris += len(tri)
+    f.seek(80)
+    f.write(struct.pack('<I', ntris))
+    f.seek(0, os.SEEK_END)
+    return nverts, ntris // 2
+
+def write_glb(f, chunks):
+    '''binary glTF 2.0 with one indexed triangle mesh, positions and indices are spooled
+       to temporary files and copied into the single binary chunk. An empty mesh is
+       written as an empty scene, glTF has no zero count accessors or empty buffers'''
+    nverts = ntris = 0
+    lo = np.full(3, np.inf, dtype=np.float32)
+    hi = np.full(3, -np.inf, dtype=np.float32)
+    with tempfile.TemporaryFile() as verts_file, tempfile.TemporaryFile() as index_file:
+        for verts, faces in chunks:
+            if not len(verts):
+                continue
+            positions = chunk_positions(verts)
+            lo = np.minimum(lo, positions.min(axis=0))
+            hi = np.maximum(hi, positions.max(axis=0))
+            verts_file.write(positions.astype('<f4').tobytes())
+            index_file.write((chunk_triangles(faces) + np.uint32(nverts)).astype('<u4').tobytes())
+            nverts += len(positions)
+            ntris += len(faces) * 2
+        verts_bytes, index_bytes = nverts * 12, ntris * 12
+        gltf = {'asset': {'version': '2.0', 'generator': 'voxCPPN'}, 'scene': 0, 'scenes': [{}]}
+        if nverts:
+            gltf['scenes'] = [{'nodes': [0]}]
+            gltf['nodes'] = [{'mesh': 0}]
+            gltf['meshes'] = [{'primitives': [{'attributes': {'POSITION': 0}, 'indices': 1}]}]
+            gltf['buffers'] = [{'byteLength': verts_bytes + index_bytes}]
+            gltf['bufferViews'] = [{'buffer': 0, 'byteOffset': 0, 'byteLength': verts_bytes, 'target': 34962},
+                                   {'buffer': 0, 'byteOffset': verts_bytes, 'byteLength': index_bytes,
+                                    'target': 34963}]
+            gltf['accessors'] = [{'bufferView': 0, 'componentType': 5126, 'count': nverts, 'type': 'VEC3',
+                                  'min': lo.tolist(), 'max': hi.tolist()},
+                                 {'bufferView': 1, 'componentType': 5125, 'count': ntris * 3, 'type': 'SCALAR'}]
+        header = json.dumps(gltf, separators=(',', ':')).encode('utf8')
+        header += b' ' * (-len(header) % 4)
+        # both buffers are 4 byte aligned already, 12 bytes per vertex and triangle
+        total = 12 + 8 + len(header) + (8 + verts_bytes + index_bytes if nverts else 0)
+        f.write(struct.pack('<4sII', b'glTF', 2, total))
+        f.write(struct.pack('<I4s', len(header), b'JSON'))
+        f.write(header)
+        if nverts:
+            f.write(struct.pack('<I4s', verts_bytes + index_bytes, b'BIN\x00'))
+            for body in (verts_file, index_file):
+                body.seek(0)
+                shutil.copyfileobj(body, f)
+    return nverts, ntris // 2
+
+def write_obj(f, chunks):
+    '''ASCII OBJ with quad faces'''
+    f.write(b'# voxCPPN\n')
+    nverts = nfaces = 0
+    for verts, faces in chunks:
+        np.savetxt(f, chunk_positions(verts), fmt='v %g %g %g')
+        # obj indices are 1 based and global
+        np.savetxt(f, np.asarray(faces, dtype=np.int64) + nverts + 1, fmt='f %d %d %d %d')
+        nverts += len(verts)
+        nfaces += len(faces)
+    return nverts, nfaces
+
+WRITERS = {'ply': write_ply, 'stl': write_stl, 'glb': write_glb, 'obj': write_obj}
+
+@instrument.timed('export')
+def export_mesh(path, chunks, fmt=None):
+    '''Write an iterable of (verts, faces) mesh chunks to path, the format defaults to
+       the file extension. Written under a temporary name and moved into place.
+       Returns the vertex and quad counts'''
+    fmt = fmt or os.path.splitext(path)[1][1:].lower()
+    if fmt not in WRITERS:
+        raise ValueError('unknown export format: {}, expected one of {}'.format(fmt, ' | '.join(FORMATS)))
+    start = time.time()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        nverts, nfaces = WRITERS[fmt](f, chunks)
+    os.replace(tmp_path, path)
+    instrument.count('bytes exported', os.path.getsize(path))
+    print('--> EXPORTED {} ({}): {} verts, {} faces, {} bytes in {:0.3f}s'.format(
+          path, fmt, nverts, nfaces, os.path.getsize(path), time.time() - start))
+    return nverts, nfaces
+
+def export_voxels(voxels, path, greedy=False, slab=32, fmt=None, level=None, max_faces=None):
+    '''mesh a binary voxel grid slab by slab, in chunks of at most max_faces faces, and
+       export it, see export_mesh and tools.iter_mesh_chunks.
+       With a level, voxels is a probability grid exported as its smooth iso-surface'''
+    if level is not None:
+        return export_mesh(path, [tools.surface_nets(voxels, level)], fmt)
+    return export_mesh(path, tools.iter_mesh_chunks(voxels, greedy, slab, max_faces), fmt)
+
+def export_frames(vox_iter, path, greedy=False, level=None):
+    '''Export every grid of vox_iter to a numbered path and pass it on, so exporting
+       can be chained in front of the viewer'''
+    for num, vox in enumerate(vox_iter):
+        export_voxels(vox, numbered_path(path, num), greedy, level=level)
+        yield vox
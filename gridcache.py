@@ -0,0 +1,130 @@
+import os
+import hashlib
+import numpy as np
+import tools
+import instrument
+
+'''Persistent, content addressed cache of model outputs: bit packed voxel grids and
+   their meshes, keyed by the model weights, latent value, size and threshold'''
+
+class GridCache:
+    '''One .npz entry per (model digest, latent, size, threshold) in a cache directory,
+       named by the sha1 of the key. An entry holds the packed grid and any meshes built
+       from it (naive and greedy). Since the key hashes the weights themselves, a
+       retrained or edited model never reads stale entries. Entries are touched when
+       read and the least recently used are deleted once the directory grows past
+       max_bytes. hits and misses count lookups in this process
+
+       cache = GridCache()
+       voxels = cache.voxels(model, 0.5, 64)
+       verts, faces = cache.mesh(model, 0.5, 64, greedy=True)
+       voxels, (verts, faces) = cache.grid(model, 0.5, 64, greedy=True)'''
+
+    def __init__(self, dirname='grid_cache', max_bytes=256 * 2 ** 20, workers=None):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        # threads evaluating the model on a miss
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model, latent, size, threshold):
+        # the model computes its digest once and keeps it
+        text = '{}:{!r}:{}:{!r}'.format(model.digest(), float(np.float32(latent)), size, float(threshold))
+        return hashlib.sha1(text.encode('ascii')).hexdigest()
+
+    def path(self, key):
+        return tools.get_path(self.dirname, key + '.npz')
+
+    def load(self, key):
+        '''entry dict or None, a hit refreshes the entry's place in the eviction order'''
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            # missing, or a corrupt entry which the next save replaces
+            return None
+        os.utime(path)
+        return entry
+
+    def save(self, key, entry):
+        '''write an entry atomically, then evict down to max_bytes'''
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **entry)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        '''delete least recently used entries until the cache fits in max_bytes'''
+        dirpath = tools.get_path(self.dirname)
+        entries = []
+        for name in os.listdir(dirpath):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(dirpath, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+    def entry(self, model, latent, size, threshold=0.5, save=True):
+        '''(key, entry, stored) for a model output, the grid is evaluated on a miss and
+           stored unless save is off. stored tells whether the entry is on disk as is'''
+        key = self.key(model, latent, size, threshold)
+        entry = self.load(key)
+        if entry is not None:
+            self.hits += 1
+            instrument.count('grid cache hits')
+            return key, entry, True
+        self.misses += 1
+        instrument.count('grid cache misses')
+        voxels = model.voxels(tools.load_coord_dataset(size), latent, size, workers=self.workers,
+                              threshold=threshold)
+        entry = {'size': np.int64(size), 'bits': np.packbits(voxels.reshape(-1) > 0.5)}
+        if save:
+            self.save(key, entry)
+        return key, entry, save
+
+    @staticmethod
+    def unpack(entry, size):
+        '''uint8 (size, size, size) grid of an entry'''
+        return np.unpackbits(entry['bits'], count=size ** 3).reshape(size, size, size)
+
+    def voxels(self, model, latent, size, threshold=0.5):
+        '''binary float32 grid as model.voxels, from the cache when present'''
+        key, entry, stored = self.entry(model, latent, size, threshold)
+        return self.unpack(entry, size).astype(np.float32)
+
+    def mesh_entry(self, model, latent, size, threshold=0.5, greedy=False):
+        '''(entry, (verts, faces)) from a single lookup, a missing mesh is built from the
+           grid and the entry is written at most once'''
+        key, entry, stored = self.entry(model, latent, size, threshold, save=False)
+        name = 'greedy' if greedy else 'naive'
+        if 'verts_' + name not in entry:
+            entry['verts_' + name], entry['faces_' + name] = tools.mesh_arrays(self.unpack(entry, size), greedy)
+            stored = False
+        if not stored:
+            self.save(key, entry)
+        return entry, (entry['verts_' + name], entry['faces_' + name])
+
+    def mesh(self, model, latent, size, threshold=0.5, greedy=False):
+        '''(verts, faces) as tools.mesh_arrays of the grid, stored with the grid entry'''
+        return self.mesh_entry(model, latent, size, threshold, greedy)[1]
+
+    def grid(self, model, latent, size, threshold=0.5, greedy=False):
+        '''(voxels, (verts, faces)) as voxels and mesh, counted as one lookup'''
+        entry, mesh = self.mesh_entry(model, latent, size, threshold, greedy)
+        return self.unpack(entry, size).astype(np.float32), mesh
+
+    def report(self):
+        '''print lookups of this process and the cache directory size'''
+        dirpath = tools.get_path(self.dirname)
+        sizes = [os.path.getsize(os.path.join(dirpath, n)) for n in os.listdir(dirpath) if n.endswith('.npz')]
+        print('--> GRID CACHE: {} hits, {} misses | {} entries, {} of {} bytes'.format(
+              self.hits, self.misses, len(sizes), sum(sizes), self.max_bytes))
@@ -0,0 +1,75 @@
+import time
+import cProfile
+import pstats
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+'''Lightweight named stage timers and counters shared by the scripts, reported with
+   --profile stages, or a cProfile dump with --profile cprofile'''
+
+# name -> [calls, seconds], in first use order
+TIMERS = OrderedDict()
+# name -> amount, e.g. voxels evaluated, faces emitted, bytes written
+COUNTERS = OrderedDict()
+
+def record(name, seconds):
+    '''add one call of seconds to the named timer'''
+    stats = TIMERS.setdefault(name, [0, 0.0])
+    stats[0] += 1
+    stats[1] += seconds
+
+@contextmanager
+def timer(name):
+    '''time the enclosed block under name, timers may nest so totals can overlap'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def timed(name):
+    '''decorator timing every call of a function under name'''
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, amount=1):
+    COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def reset():
+    TIMERS.clear()
+    COUNTERS.clear()
+
+def report(wall=None):
+    '''print the stage breakdown, shares are of wall seconds when given'''
+    print('--> PROFILE stages{}'.format('' if wall is None else ' of {:0.3f}s wall'.format(wall)))
+    for name, (calls, seconds) in TIMERS.items():
+        share = '' if not wall else ' {:>6.1%}'.format(seconds / wall)
+        print('-->   {:<20} {:>6} calls {:>9.4f}s{}'.format(name, calls, seconds, share))
+    for name, amount in COUNTERS.items():
+        print('-->   {:<20} {:>16}'.format(name, amount))
+
+def run(fn, mode=None, path='profile.prof'):
+    '''Call fn under the profiling mode: None, stages (timer and counter report) or
+       cprofile (stats dumped to path and the top functions printed)'''
+    if mode not in (None, 'stages', 'cprofile'):
+        raise ValueError('unknown profile mode: {}, expected stages | cprofile'.format(mode))
+    reset()
+    start = time.perf_counter()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(fn)
+        finally:
+            profiler.dump_stats(path)
+            print('--> PROFILE written to {}'.format(path))
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        fn()
+    if mode is not None:
+        report(time.perf_counter() - start)
@@ -0,0 +1,329 @@
+import os
+import time
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tools
+import instrument
+from store import ShapeStore
+
+'''NumPy inference for the trained voxel network, no tensorflow needed'''
+
+# model bundle format, bump when keys change meaning
+BUNDLE_VERSION = 1
+
+# bytes per voxel of a slab evaluated out of core: coords, probabilities and occupancy
+SLAB_EVAL_BYTES = 24
+# bytes per row of an evaluated chunk: both hidden layers, their temporaries and the output
+FORWARD_ROW_BYTES = 128
+# smallest chunk out of core evaluation shrinks to for a tight budget
+MIN_SLAB_CHUNK = 1024
+
+def save_bundle(path, weights, biases, latents, size, seed, epoch):
+    '''Save a self describing, pickle free .npz model bundle: weights w1 w2 w3, biases
+       b1 b2, the latent value of every encoded shape, the training size and seed, and
+       the last trained epoch. Written to a temporary file and moved over path, so a
+       crash never leaves a partial bundle behind'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, version=np.int64(BUNDLE_VERSION),
+                 w1=weights[0], w2=weights[1], w3=weights[2], b1=biases[0], b2=biases[1],
+                 latents=np.asarray(latents, dtype=np.float64).reshape(-1),
+                 size=np.int64(size), seed=np.int64(seed), epoch=np.int64(epoch))
+    os.replace(tmp_path, path)
+
+def load_bundle(path):
+    '''load a model bundle written by save_bundle into a dict, without pickle'''
+    with np.load(path, allow_pickle=False) as data:
+        bundle = {key: data[key] for key in data.files}
+    if int(bundle['version']) > BUNDLE_VERSION:
+        raise ValueError('model bundle {} has version {}, newest supported is {}'.format(
+                         path, int(bundle['version']), BUNDLE_VERSION))
+    for key in ('version', 'size', 'seed', 'epoch'):
+        bundle[key] = int(bundle[key])
+    return bundle
+
+def slab_plan(size, budget, chunk=65536, workers=None):
+    '''(chunk, layers) for out of core evaluation of a size grid within budget bytes.
+       chunk is shrunk when the budget cannot hold it next to one slab layer, a
+       ValueError is raised when even MIN_SLAB_CHUNK does not fit'''
+    threads = max(workers or 1, 1)
+    # one slab layer and the radius layer the coordinates are filled through
+    layer = size * size * (SLAB_EVAL_BYTES + tools.RADIUS_LAYER_BYTES)
+    chunk = min(chunk, (budget - layer) // (FORWARD_ROW_BYTES * threads))
+    if chunk < MIN_SLAB_CHUNK:
+        raise ValueError('a budget of {:0.1f} MB is too small for {}^3 out of core evaluation, '
+                         'it needs at least {:0.1f} MB'.format(
+                         budget / 2 ** 20, size, (layer + FORWARD_ROW_BYTES * MIN_SLAB_CHUNK * threads) / 2 ** 20))
+    reserve = size * size * tools.RADIUS_LAYER_BYTES + FORWARD_ROW_BYTES * chunk * threads
+    return chunk, tools.slab_layers(size, budget, SLAB_EVAL_BYTES, reserve)
+
+def legacy_latents(seed, dirname='shapes'):
+    '''latent vector of a legacy model.npy, regenerated the way net.py drew it:
+       from the seed and the number of stored shapes'''
+    np.random.seed(seed)
+    shape_amount = len(ShapeStore.open(dirname))
+    return np.random.uniform(size=(shape_amount, 1))
+
+class VoxelModel:
+    '''The trained 5 -> 10 -> 10 -> 1 tanh/tanh/sigmoid network evaluated in float32 numpy.
+       Input rows are (x, y, z, radius, latent), output is the voxel probability.
+
+       model = VoxelModel.load('model.npz')
+       probs = model.predict(tools.load_coord_dataset(64), 0.5)
+
+       The first layer projection of the coordinates does not depend on the latent, so
+       when a grid size is given to predict it is computed once and cached for the
+       cache_sizes most recently used sizes (size ** 3 * 40 bytes each). Every further
+       latent value on that grid only adds a rank 1 latent * W1[4] term. That only pays
+       off over many latents, so single grids are evaluated in plain chunks and only
+       iter_voxels uses the cache'''
+
+    def __init__(self, weights, biases, cache_sizes=2):
+        self.w1, self.w2, self.w3 = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.b1, self.b2 = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        # the latent is the last input column, split it off so inputs never need np.append
+        self.w1_coords = np.ascontiguousarray(self.w1[:4])
+        self.w1_latent = np.ascontiguousarray(self.w1[4])
+        self.cache_sizes = cache_sizes
+        self.projections = OrderedDict()
+        # filled in from a model bundle
+        self.latents = None
+        self.size = None
+        self.seed = None
+        # sha1 of the parameters, computed on first use by digest
+        self.params_digest = None
+
+    @classmethod
+    def load(cls, path='model.npz'):
+        '''Load a model bundle from save_bundle, or a legacy np.save(path, [W, B]) .npy,
+           which needs pickle and carries no latents'''
+        if not path.endswith('.npy'):
+            bundle = load_bundle(path)
+            model = cls([bundle['w1'], bundle['w2'], bundle['w3']], [bundle['b1'], bundle['b2']])
+            model.latents = bundle['latents'].reshape(-1, 1)
+            model.size = bundle['size']
+            model.seed = bundle['seed']
+            return model
+        params = np.load(path, allow_pickle=True)
+        return cls(params[0], params[1])
+
+    def latent_vec(self, seed=None):
+        '''(shape_amount, 1) latent vector, from the bundle or regenerated for legacy models'''
+        if self.latents is not None:
+            return self.latents
+        return legacy_latents(seed)
+
+    def digest(self):
+        '''sha1 hex digest of the float32 weights and biases, identifies the model's outputs.
+           Computed once per model, weights are not changed in place after construction'''
+        if self.params_digest is None:
+            sha = hashlib.sha1()
+            for param in (self.w1, self.w2, self.w3, self.b1, self.b2):
+                sha.update(str(param.shape).encode('ascii'))
+                sha.update(param.tobytes())
+            self.params_digest = sha.hexdigest()
+        return self.params_digest
+
+    def project(self, coords, size=None, chunk=65536):
+        '''First layer coordinate projection coords @ W1[:4], the latent invariant part
+           of the first layer. Cached per grid size when size is given'''
+        if size is not None and size in self.projections:
+            self.projections.move_to_end(size)
+            return self.projections[size]
+        coords = np.asarray(coords, dtype=np.float32)
+        proj = np.empty((len(coords), len(self.b1)), dtype=np.float32)
+        for start in range(0, len(coords), chunk):
+            np.matmul(coords[start:start + chunk], self.w1_coords, out=proj[start:start + chunk])
+        if size is not None and self.cache_sizes:
+            self.projections[size] = proj
+            while len(self.projections) > self.cache_sizes:
+                self.projections.popitem(last=False)
+        return proj
+
+    def forward(self, coords, latent, proj=None):
+        '''evaluate one block of (n, 4) coords, latent is a scalar or (n,) array.
+           proj is the block's precomputed coordinate projection, coords are unused then'''
+        latent = np.asarray(latent, dtype=np.float32)
+        if latent.ndim:
+            latent = latent.reshape(-1, 1)
+        if proj is None:
+            hidden1 = coords @ self.w1_coords
+            hidden1 += latent * self.w1_latent
+        else:
+            hidden1 = proj + latent * self.w1_latent
+        hidden1 += self.b1
+        np.tanh(hidden1, out=hidden1)
+        hidden2 = hidden1 @ self.w2
+        hidden2 += self.b2
+        np.tanh(hidden2, out=hidden2)
+        out = (hidden2 @ self.w3)[:, 0]
+        # sigmoid
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        out += 1
+        np.reciprocal(out, out=out)
+        return out
+
+    @instrument.timed('evaluate')
+    def predict(self, coords, latent, chunk=65536, workers=None, size=None):
+        '''Voxel probabilities (n,) float32 for (n, 4) coords and a scalar or (n,) latent.
+           Evaluated chunk rows at a time, spread over a thread pool when workers > 1.
+           Passing the grid size reuses the cached coordinate projection for it'''
+        coords = np.asarray(coords, dtype=np.float32)
+        latent = np.asarray(latent, dtype=np.float32)
+        n = len(coords)
+        instrument.count('voxels evaluated', n)
+        out = np.empty(n, dtype=np.float32)
+        proj = self.project(coords, size, chunk) if size is not None else None
+
+        def run(start):
+            stop = min(start + chunk, n)
+            lat = latent[start:stop] if latent.ndim else latent
+            block = proj[start:stop] if proj is not None else None
+            out[start:stop] = self.forward(coords[start:stop], lat, block)
+
+        starts = range(0, n, chunk)
+        if workers is not None and workers > 1 and n > chunk:
+            with ThreadPoolExecutor(workers) as pool:
+                list(pool.map(run, starts))
+        else:
+            for start in starts:
+                run(start)
+        return out
+
+    def probabilities(self, coords, latent, size, chunk=65536, workers=None, cached=False):
+        '''float32 probability grid (size, size, size) for a coordinate dataset of that
+           size, the continuous field tools.surface_nets meshes smooth. cached goes
+           through the coordinate projection cache of size'''
+        return self.predict(coords, latent, chunk, workers, size if cached else None).reshape(size, size, size)
+
+    def voxels(self, coords, latent, size, chunk=65536, workers=None, threshold=0.5, cached=False):
+        '''Binary float32 voxel grid (size, size, size) for a coordinate dataset of that
+           size, voxels with a probability above threshold are set. At 0.5 this equals
+           rounding the probabilities'''
+        probs = self.probabilities(coords, latent, size, chunk, workers, cached)
+        return (probs > threshold).astype(np.float32)
+
+    def voxels_out_of_core(self, latent, size, path, budget=256 * 2 ** 20, chunk=65536, workers=None,
+                           threshold=0.5):
+        '''Binary occupancy grid (size, size, size) evaluated one slab of layers at a time
+           into a uint8 .npy memory map at path, so no full size grid of coordinates or
+           probabilities ever exists. Slabs are sized to fit budget bytes, and each slab
+           of the map is released once written, see slab_plan. Returns a tools.GridFile of path, which iter_mesh_chunks and the
+           exporters read slab by slab'''
+        chunk, layers = slab_plan(size, budget, chunk, workers)
+        print('--> OUT OF CORE {}^3: {} layer slabs of {} row chunks within {:0.1f} MB'.format(
+              size, layers, chunk, budget / 2 ** 20))
+        grid = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(size, size, size))
+        offset = grid.offset
+        del grid
+        for start, stop, coords in tools.iter_coord_slabs(size, layers):
+            probs = self.predict(coords, latent, chunk, workers)
+            del coords
+            block = np.memmap(path, np.uint8, 'r+', offset + start * size * size, (stop - start) * size * size)
+            np.greater(probs, threshold, out=block)
+            block.flush()
+            del block, probs
+        return tools.GridFile(path)
+
+    def iter_voxels(self, coords, latents, size, chunk=65536, workers=None, threshold=0.5):
+        '''Generator of binary voxel grids, one per latent value. Each frame is only
+           evaluated when it is pulled, so a consumer that drops frames keeps memory flat.
+           All frames share the cached coordinate projection for size. A threshold of
+           None yields the probability grids instead'''
+        for latent in latents:
+            if threshold is None:
+                yield self.probabilities(coords, latent, size, chunk, workers, cached=True)
+            else:
+                yield self.voxels(coords, latent, size, chunk, workers, threshold, cached=True)
+
+    def adaptive_voxels(self, size, latent, start=8, margin=0.1, chunk=65536):
+        '''Coarse to fine evaluation of the binary voxel grid. The network is evaluated on a
+           lattice with spacing start; blocks whose corner predictions all agree and are
+           further than margin from the 0.5 threshold are filled without evaluating their
+           inside, the rest are split in 8 and refined down to single voxels.
+           Returns the uint8 grid and the number of network evaluations. Thin features that
+           fall between the corners of a uniform block are missed, see compare_adaptive'''
+        step = 1
+        while step * 2 <= min(start, size):
+            step *= 2
+        padded = -(-size // step) * step
+        # per voxel state: 0 not evaluated, 1 empty, 2 empty near threshold, 3 full near, 4 full
+        state = np.zeros((size, size, size), dtype=np.uint8)
+        out = np.zeros((padded, padded, padded), dtype=np.uint8)
+        evaluated = 0
+        corner_offsets = [(a, b, c) for a in (0, 1) for b in (0, 1) for c in (0, 1)]
+        # blocks still to resolve at the current step, all of them on the coarsest level
+        nb = padded // step
+        active = np.ones((nb, nb, nb), dtype=bool)
+        while True:
+            # lattice point n sits at voxel min(n * step, size - 1)
+            lattice = np.minimum(np.arange(nb + 1) * step, size - 1)
+            need = np.zeros((nb + 1,) * 3, dtype=bool)
+            for a, b, c in (corner_offsets if step > 1 else [(0, 0, 0)]):
+                need[a:a + nb, b:b + nb, c:c + nb] |= active
+            if nb > 1 and lattice[-2] == lattice[-1]:
+                # the last two lattice points fall on the same voxel, evaluate it once
+                need[-2] |= need[-1]
+                need[:, -2] |= need[:, -1]
+                need[:, :, -2] |= need[:, :, -1]
+                need[-1], need[:, -1], need[:, :, -1] = False, False, False
+            index = lattice[np.stack(np.nonzero(need), axis=1)]
+            index = index[state[index[:, 0], index[:, 1], index[:, 2]] == 0]
+            if len(index):
+                probs = self.predict(tools.grid_coords(size, index), latent, chunk)
+                full = probs > 0.5
+                near = np.abs(probs - 0.5) < margin
+                state[index[:, 0], index[:, 1], index[:, 2]] = np.where(full, np.where(near, 3, 4),
+                                                                         np.where(near, 2, 1))
+                evaluated += len(index)
+
+            codes = state[np.ix_(lattice, lattice, lattice)]
+            if step == 1:
+                # single voxel blocks, the origin corner is the voxel itself
+                resolved = active
+                value = codes[:-1, :-1, :-1] >= 3
+            else:
+                empty = np.ones_like(active)
+                full = np.ones_like(active)
+                for a, b, c in corner_offsets:
+                    corner = codes[a:a + nb, b:b + nb, c:c + nb]
+                    empty &= corner == 1
+                    full &= corner == 4
+                resolved = active & (empty | full)
+                value = full
+            # fill resolved blocks through a block view of the padded output grid
+            view = out.reshape(nb, step, nb, step, nb, step)
+            np.copyto(view, value[:, None, :, None, :, None], where=resolved[:, None, :, None, :, None],
+                      casting='unsafe')
+            if step == 1:
+                break
+            # split unresolved blocks into 8 children
+            split = active & ~resolved
+            if not split.any():
+                break
+            step //= 2
+            nb *= 2
+            active = split.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+            # children starting outside the grid have nothing to fill
+            outside = -(-size // step)
+            active[outside:], active[:, outside:], active[:, :, outside:] = False, False, False
+        return np.ascontiguousarray(out[:size, :size, :size]), evaluated
+
+    def compare_adaptive(self, coords, latent, size, start=8, margin=0.1):
+        '''Print evaluations, time and voxel mismatch rate of adaptive_voxels against
+           dense evaluation for one latent value'''
+        t = time.time()
+        dense = self.voxels(coords, latent, size)
+        dense_time = time.time() - t
+        t = time.time()
+        adaptive, evaluated = self.adaptive_voxels(size, latent, start, margin)
+        adaptive_time = time.time() - t
+        mismatch = np.count_nonzero(dense != adaptive) / dense.size
+        print('--> ADAPTIVE {}^3: dense {} evals {:0.3f}s | adaptive {} evals ({:0.1%}) {:0.3f}s | '
+              'mismatch {:0.4%}'.format(size, dense.size, dense_time, evaluated, evaluated / dense.size,
+                                       adaptive_time, mismatch))
+        return {'evaluated': evaluated, 'mismatch': mismatch,
+                'dense_time': dense_time, 'adaptive_time': adaptive_time}
@@ -1,16 +1,40 @@
 import os
 import sys
+import json
 import argparse
 import time
 import tensorflow as tf 
 import numpy as np 
 import tools
+import export
+import instrument
+from model import VoxelModel, save_bundle, load_bundle
+from dataset import ShapeDataset
+from store import ShapeStore
+
+def resume_bundle(path, size, shape_amount):
+    '''model bundle training resumes from, a ValueError when it was trained at another
+       size or on another number of shapes than the current run'''
+    bundle = load_bundle(path)
+    if bundle['size'] != size:
+        raise ValueError('{} was trained at size {}, resume with --size {}'.format(path, bundle['size'], bundle['size']))
+    if len(bundle['latents']) != shape_amount:
+        raise ValueError('{} was trained on {} shapes but the shape store holds {}, '
+                         'resume on the same shapes or train from scratch'.format(
+                         path, len(bundle['latents']), shape_amount))
+    return bundle
 
 def main(args):
     '''Simple feed forward neural network for voxel shape encoding and generative 
        modeling with latent vectors. Uses Tensorflow and can easily run on a CPU.
 
-       usage: net.py [-h] [--op OP] [--size SIZE] [--seed SEED]
+       usage: net.py [-h] [--op OP] [--size SIZE] [--seed SEED] [--shuffle]
+                     [--sampler SAMPLER] [--rest_ratio REST_RATIO] [--samples SAMPLES]
+                     [--model MODEL] [--checkpoint CHECKPOINT] [--resume]
+                     [--iters ITERS] [--monitor MONITOR] [--log LOG] [--patience PATIENCE]
+                     [--min_delta MIN_DELTA] [--target_loss TARGET_LOSS] [--fused FUSED]
+                     [--steps STEPS] [--workers WORKERS] [--mesh MESH] [--level LEVEL]
+                     [--export EXPORT] [--no_browser] [--payload PAYLOAD] [--profile PROFILE]
 
         optional arguments:
         -h, --help   show this help message and exit
@@ -18,6 +42,39 @@ def main(args):
         --size SIZE  Voxel dimensions cubed, can be different size for train vs
                     latent op
         --seed SEED  tensorflow weight init seed
+        --shuffle    train on shuffled minibatches mixing voxels of all shapes
+        --sampler SAMPLER  training samples per epoch: uniform (every voxel) | surface
+        --rest_ratio REST_RATIO  surface sampler share of the non surface voxels
+                    drawn per epoch
+        --samples SAMPLES  epochs between loss samples
+        --model MODEL  model bundle path, latent op also reads a legacy model.npy
+        --checkpoint CHECKPOINT  save the model bundle every this many epochs, 0 is
+                    only at the end
+        --resume     continue training from the model bundle, trained at the same
+                    --size on the same shapes
+        --iters ITERS  maximum training epochs
+        --monitor MONITOR  voxels per shape in the fixed loss estimate subset
+        --log LOG    per shape loss log, one json object per loss sample
+        --patience PATIENCE  stop after this many loss samples without
+                    improvement, 0 is off
+        --min_delta MIN_DELTA  summed loss decrease that counts as an improvement
+        --target_loss TARGET_LOSS  stop once every per shape loss sample is at or
+                    below this
+        --fused FUSED  train this many shuffled mixed shape minibatches per session
+                    call, 0 is off
+        --steps STEPS  latent op frames, default 20 below size 128 and 5 above
+        --workers WORKERS  processes meshing and encoding latent op frames
+        --mesh MESH  mesher: naive | greedy | delta (latent op, incremental frames) |
+                    smooth (iso-surface of the probabilities) | compare (report
+                    both, render greedy)
+        --level LEVEL  iso-level of the probability field meshed by --mesh smooth
+        --export EXPORT  also write meshes to this .ply | .stl | .glb | .obj path,
+                    numbered per shape or frame
+        --no_browser  skip the viewer pages and browser, e.g. on headless hosts
+        --payload PAYLOAD  viewer mesh format: base64 | bin | json | compare
+                    (report all, write base64). bin needs the templates dir served over http
+        --profile PROFILE  stages (timer and counter breakdown) | cprofile (dump
+                    net.prof)
        
        The network is very small which allows for fast training (<10 min on CPU). However it should 
        be noted that there is a balance with network size and the net's ability to 
@@ -26,34 +83,27 @@ def main(args):
        
        For training: train at a low resolution using the SIZE CLI argument, 32 works well
        For running the net/latent space visualizations: SIZE 32-128 are good visualization 
-       resoultions. Be careful with this becuase you can quickly run out of memory.
+       resoultions. Be careful with this becuase you can quickly run out of memory,
+       run.py --budget_mb builds larger single shapes out of core.
 
        Author: Dominic Cascino
        Date: Oct 2017'''
     # hyper paramters
     batch_size = 1000
     lr = 0.001
-    iters = 2000
-    samples = 100
+    iters = args.iters
+    samples = args.samples
     size = args.size
     vol = size ** 3
     seed = args.seed
     np.random.seed(seed)
     tf.set_random_seed(seed)
-    shape_amount = len(os.listdir(tools.get_path('shapes')))
-    save_path = 'model'
-    # dataset
-    coord_vec = tools.load_coord_dataset(size)
+    shape_amount = len(ShapeStore.open())
+    save_path = args.model
+    # smooth meshes the probability field at the iso-level instead of rounded voxels
+    level = args.level if args.mesh == 'smooth' else None
     # scalar latent vector for each shape, latent space is only 1d
     latent_vec = np.random.uniform(size=(shape_amount, 1))    
-    xdata = []
-    ydata = []
-
-    for i in range(shape_amount):
-        latent = np.expand_dims(latent_vec[i], axis=0).repeat(vol, axis=0)
-        shape_path = tools.get_path('shapes', 'shape{}.npy'.format(i))
-        xdata.append(np.append(coord_vec, latent, axis=1))
-        ydata.append(np.expand_dims(np.load(shape_path).flatten(), axis=1))
 
     # small feed forward neural network graph
     # a small network seems to work better, the less paramters, 
@@ -61,49 +111,149 @@ def main(args):
     x = tf.placeholder(tf.float32, [None, 5])
     y = tf.placeholder(tf.float32, [None, 1])
 
-    w1 = tf.Variable(tf.random_uniform([5, 10]))
-    w2 = tf.Variable(tf.random_uniform([10, 10]))   
-    w3 = tf.Variable(tf.random_uniform([10, 1]))
+    # resource variables are read where they are used, so each step of the fused
+    # training loop sees the weights updated by the step before it
+    w1 = tf.Variable(tf.random_uniform([5, 10]), use_resource=True)
+    w2 = tf.Variable(tf.random_uniform([10, 10]), use_resource=True)
+    w3 = tf.Variable(tf.random_uniform([10, 1]), use_resource=True)
 
-    b1 = tf.Variable(tf.random_uniform([10]))
-    b2 = tf.Variable(tf.random_uniform([10]))
+    b1 = tf.Variable(tf.random_uniform([10]), use_resource=True)
+    b2 = tf.Variable(tf.random_uniform([10]), use_resource=True)
 
-    hidden1 = tf.tanh(tf.matmul(x, w1) + b1)
-    hidden2 = tf.tanh(tf.matmul(hidden1, w2) + b2)    
-    output = tf.nn.sigmoid(tf.matmul(hidden2, w3))
+    def network(inputs):
+        hidden1 = tf.tanh(tf.matmul(inputs, w1) + b1)
+        hidden2 = tf.tanh(tf.matmul(hidden1, w2) + b2)    
+        return tf.nn.sigmoid(tf.matmul(hidden2, w3))
+
+    output = network(x)
 
     # loss and optim
     loss = tf.reduce_sum(tf.square(y - output))
-    train = tf.train.GradientDescentOptimizer(lr).minimize(loss)
+    optimizer = tf.train.GradientDescentOptimizer(lr)
+    train = optimizer.minimize(loss)
+
+    if args.fused:
+        # fused training: a stack of mixed shape minibatches is fed at once and
+        # trained one gradient step per minibatch in an in graph loop, so there is
+        # one python -> tf round trip per args.fused steps instead of per step
+        x_steps = tf.placeholder(tf.float32, [None, None, 5])
+        y_steps = tf.placeholder(tf.float32, [None, None, 1])
+
+        def fused_step(i, total):
+            # i only advances after the previous update, the weight reads wait for it
+            with tf.control_dependencies([i]):
+                step_loss = tf.reduce_sum(tf.square(y_steps[i] - network(x_steps[i])))
+            update = optimizer.minimize(step_loss)
+            with tf.control_dependencies([update]):
+                return i + 1, total + step_loss
+
+        fused_train = tf.while_loop(lambda i, total: i < tf.shape(x_steps)[0], fused_step,
+                                    [tf.constant(0), tf.constant(0.0)], parallel_iterations=1)
     init = tf.global_variables_initializer()
 
     if args.op == 'train':
+        start_epoch = 0
+        if args.resume:
+            # continue from the last checkpoint, with the latents it was trained on
+            bundle = resume_bundle(save_path, size, shape_amount)
+            latent_vec = bundle['latents'].reshape(-1, 1)
+            start_epoch = bundle['epoch'] + 1
+            print('resuming {} at epoch {}'.format(save_path, start_epoch))
+        # dataset, the coordinate grid is shared by all shapes and the
+        # targets are bit packed, minibatches are assembled on the fly
+        data = ShapeDataset.load(size, latent_vec)
         # training loop
+        # loss is estimated on a fixed random voxel subset of each shape and scaled to
+        # the full volume, so samples stay comparable to a full sweep
+        monitor = data.monitor_voxels(args.monitor, seed)
+        monitor_data = [data.shape_data(shp, voxels=monitor[shp]) for shp in range(shape_amount)]
+        loss_scale = vol / monitor.shape[1]
+        best_loss = np.inf
+        stale = 0
+        log = open(args.log, 'a' if args.resume else 'w')
+
+        def save(sess, epoch):
+            # self describing model bundle, atomically replaced
+            W = sess.run([w1, w2, w3])
+            B = sess.run([b1, b2])
+            save_bundle(save_path, W, B, latent_vec, size, seed, epoch)
+
         with tf.Session() as sess:
             sess.run(init)
-            for i in range(iters):
-                for j in range(0, vol, batch_size):
-                    # train on each shape one after the other
-                    for k in range(shape_amount):
-                        sess.run(train, feed_dict={x: xdata[k][j:batch_size+j], y: ydata[k][j:batch_size+j]})
+            if args.resume:
+                for var, key in zip([w1, w2, w3, b1, b2], ['w1', 'w2', 'w3', 'b1', 'b2']):
+                    var.load(bundle[key], sess)
+            train_start = time.time()
+            epoch_time = 0
+            epochs = 0
+            epoch_samples = 0
+            # last trained epoch, kept when resuming a finished run
+            i = start_epoch - 1
+            for i in range(start_epoch, iters):
+                epoch_start = time.time()
+                # surface sampler: all surface voxels plus a random share of the rest
+                pairs = data.surface_epoch(args.rest_ratio) if args.sampler == 'surface' else None
+                if args.fused:
+                    for xb, yb in data.stacked_batches(batch_size, args.fused, pairs=pairs):
+                        sess.run(fused_train, feed_dict={x_steps: xb, y_steps: yb})
+                else:
+                    # without --shuffle each slice is trained on each shape one after the other
+                    for xb, yb in data.batches(batch_size, shuffle=args.shuffle, pairs=pairs):
+                        sess.run(train, feed_dict={x: xb, y: yb})
+                epoch_time += time.time() - epoch_start
+                instrument.record('train epoch', time.time() - epoch_start)
+                instrument.count('samples trained', len(data) if pairs is None else len(pairs))
+                epoch_samples += len(data) if pairs is None else len(pairs)
+                epochs += 1
+                if args.checkpoint and (i + 1) % args.checkpoint == 0:
+                    save(sess, i)
 
                 if i % samples == 0:
-                    # loss sampling
-                    print('epoch', i)
-                    for shp in range(shape_amount):
-                        e = sess.run(loss, feed_dict={x: xdata[shp], y: ydata[shp]})
+                    # loss sampling and throughput since the last sample
+                    print('epoch {}    {:0.3f}s/epoch    {:0.0f} samples/s'.format(
+                          i, epoch_time / epochs, epoch_samples / epoch_time))
+                    epoch_time = 0
+                    epoch_samples = 0
+                    epochs = 0
+                    losses = []
+                    for shp, (xs, ys) in enumerate(monitor_data):
+                        with instrument.timer('loss sample'):
+                            e = sess.run(loss, feed_dict={x: xs, y: ys}) * loss_scale
+                        losses.append(float(e))
                         print('loss{} {:0.3f}    '.format(shp, e), end='', flush=True)
                     print('\n')
+                    log.write(json.dumps({'epoch': i, 'time': time.time() - train_start, 'loss': losses}) + '\n')
+                    log.flush()
+                    if args.target_loss is not None and max(losses) <= args.target_loss:
+                        print('target loss {} reached by every shape at epoch {} after {:0.2f} min'.format(
+                              args.target_loss, i, (time.time() - train_start) / 60))
+                        break
+                    # early stopping on the summed loss estimate
+                    if sum(losses) < best_loss - args.min_delta:
+                        best_loss = sum(losses)
+                        stale = 0
+                    else:
+                        stale += 1
+                        if args.patience and stale >= args.patience:
+                            print('converged: no loss improvement over {} at {} samples, stopping at epoch {}'.format(
+                                  args.min_delta, stale, i))
+                            break
+
+            log.close()
+            print('train time (min) {:0.2f}'.format((time.time() - train_start) / 60))
+            save(sess, i)
 
             # save model here
-            for data in xdata:
-                out = sess.run(output, feed_dict={x: data})
-                tools.render_voxels(np.rint(out).reshape(size, size, size))
-            
-            # save just the weights
-            W = sess.run([w1, w2, w3])
-            B = sess.run([b1, b2])
-            np.save(save_path, [W, B])
+            for shp in range(shape_amount):
+                with instrument.timer('tf inference'):
+                    out = sess.run(output, feed_dict={x: data.shape_data(shp)[0]})
+                voxels = out.reshape(size, size, size) if level is not None else np.rint(out).reshape(size, size, size)
+                if args.export:
+                    export.export_voxels(voxels, export.numbered_path(args.export, shp),
+                                         greedy=args.mesh in ('greedy', 'compare'), level=level)
+                if not args.no_browser:
+                    tools.render_voxels(voxels, greedy=args.mesh in ('greedy', 'compare'), payload=args.payload,
+                                        level=level)
 
     elif args.op == 'latent':
         # dataset
@@ -113,51 +263,46 @@ def main(args):
         # this means that the model can train on a low resolution and 
         # output an arbitrary resolution shape after training
         coord_vec = tools.load_coord_dataset(args.size)
-        vol = args.size ** 3
+
+        # restore model, evaluated in numpy without building a tf graph,
+        # a model bundle carries the latents it was trained with
+        model = VoxelModel.load(save_path)
+        latent_vec = model.latent_vec(seed)
         print('latent vector inputs\n', latent_vec)
 
         lmin, lmax = np.amin(latent_vec), np.amax(latent_vec)
-        # steps: how many shapes to build and render in animation
-        # resolution 32 -> 20ish steps
-        # resolution 64 -> 20ish steps
-        # resolution 128 -> 5 steps, dont go above 10
-        # resolution 256 -> you will probably run out of memory!
-        steps = 5
-        if args.size < 128:
-            steps = 20
+        # steps: how many shapes to build and render in animation,
+        # frames are streamed so memory does not grow with the step count
+        steps = args.steps
+        if steps is None:
+            steps = 20 if args.size < 128 else 5
         shifts = np.linspace(lmin, lmax, steps)
-        data_list = []
-        base = np.ones((vol, 1))
-        # traverse the latent space between the latent vector inputs
-        for i in range(steps):
-            latent_shift = shifts[i] * base
-            # np.append is a memory issue for large sizes 128-256,
-            # since it makes copies of the original array
-            data_list.append(np.append(coord_vec, latent_shift, axis=1))
-
-        # restore model, just uses numpy saving and not tf saver
-        params = np.load(save_path + '.npy')
-
-        x = tf.placeholder(tf.float32, [None, 5])
-        W = params[0]
-        B = params[1]
-        w1 = tf.constant(W[0])
-        w2 = tf.constant(W[1])
-        w3 = tf.constant(W[2])
-        b1 = tf.constant(B[0])
-        b2 = tf.constant(B[1])
-
-        hidden1 = tf.tanh(tf.matmul(x, w1) + b1)
-        hidden2 = tf.tanh(tf.matmul(hidden1, w2) + b2)    
-        output = tf.nn.sigmoid(tf.matmul(hidden2, w3))
 
-        results = []
-        with tf.Session() as sess:
-            for data in data_list:
-                results.append(np.rint(sess.run(output, feed_dict={x: data}).reshape(size, size, size)))
+        if args.mesh == 'compare' or args.payload == 'compare':
+            # reports are made on the first frame of the traversal
+            first = model.voxels(coord_vec, shifts[0], args.size)
+            if args.mesh == 'compare':
+                tools.compare_meshers(first)
+            if args.payload == 'compare':
+                if level is not None:
+                    first = model.probabilities(coord_vec, shifts[0], args.size)
+                tools.compare_payloads([tools.mesh_grid(first, args.mesh in ('greedy', 'compare'), level)])
+                args.payload = 'base64'
+            del first
 
-        # render the latent space traversal as animation in browser
-        tools.render_voxel_ani(results)
+        # traverse the latent space between the latent vector inputs,
+        # one frame is evaluated, meshed and written to the page at a time
+        # smooth frames are the probability grids
+        frames = model.iter_voxels(coord_vec, shifts, args.size, threshold=None if level is not None else 0.5)
+        if args.export:
+            frames = export.export_frames(frames, args.export, greedy=args.mesh in ('greedy', 'compare'), level=level)
+        if args.no_browser:
+            # exports happen as the frames are pulled
+            for _ in frames:
+                pass
+            return
+        tools.render_voxel_ani(frames, greedy=args.mesh in ('greedy', 'compare'), payload=args.payload,
+                               delta=args.mesh == 'delta', workers=args.workers, level=level)
             
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -167,6 +312,56 @@ if __name__ == '__main__':
                         help='Voxel dimensions cubed, can be different size for train vs latent op')
     parser.add_argument('--seed', type=int, default=256,
                         help='tensorflow weight init seed')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='train on shuffled minibatches mixing voxels of all shapes')
+    parser.add_argument('--sampler', type=str, default='uniform',
+                        help='training samples per epoch: uniform (every voxel) | surface')
+    parser.add_argument('--rest_ratio', type=float, default=0.1,
+                        help='surface sampler share of the non surface voxels drawn per epoch')
+    parser.add_argument('--samples', type=int, default=100,
+                        help='epochs between loss samples')
+    parser.add_argument('--model', type=str, default='model.npz',
+                        help='model bundle path, latent op also reads a legacy model.npy')
+    parser.add_argument('--checkpoint', type=int, default=100,
+                        help='save the model bundle every this many epochs, 0 is only at the end')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue training from the model bundle, trained at the same --size on the same shapes')
+    parser.add_argument('--iters', type=int, default=2000,
+                        help='maximum training epochs')
+    parser.add_argument('--monitor', type=int, default=4096,
+                        help='voxels per shape in the fixed loss estimate subset')
+    parser.add_argument('--log', type=str, default='train_log.jsonl',
+                        help='per shape loss log, one json object per loss sample')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='stop after this many loss samples without improvement, 0 is off')
+    parser.add_argument('--min_delta', type=float, default=0.0,
+                        help='summed loss decrease that counts as an improvement')
+    parser.add_argument('--target_loss', type=float, default=None,
+                        help='stop once every per shape loss sample is at or below this')
+    parser.add_argument('--fused', type=int, default=0,
+                        help='train this many shuffled mixed shape minibatches per session call, 0 is off')
+    parser.add_argument('--steps', type=int, default=None,
+                        help='latent op frames, default 20 below size 128 and 5 above')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes meshing and encoding latent op frames')
+    parser.add_argument('--mesh', type=str, default='naive',
+                        help='mesher: naive | greedy | delta (latent op, incremental frames) | smooth (iso-surface of the probabilities) | compare (report both, render greedy)')
+    parser.add_argument('--level', type=float, default=0.5,
+                        help='iso-level of the probability field meshed by --mesh smooth')
+    parser.add_argument('--export', type=str, default=None,
+                        help='also write meshes to this .ply | .stl | .glb | .obj path, numbered per shape or frame')
+    parser.add_argument('--no_browser', action='store_true',
+                        help='skip the viewer pages and browser, e.g. on headless hosts')
+    parser.add_argument('--payload', type=str, default='base64',
+                        help='viewer mesh format: base64 | bin | json | compare (report all, write base64)')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='stages (timer and counter breakdown) | cprofile (dump net.prof)')
+    args = parser.parse_args()
+    if args.op == 'train' and args.resume:
+        try:
+            resume_bundle(args.model, args.size, len(ShapeStore.open()))
+        except (OSError, ValueError) as e:
+            parser.error('--resume: {}'.format(e))
     start = time.time()
-    main(parser.parse_args())
+    instrument.run(lambda: main(args), args.profile, 'net.prof')
     print('time (min)', (time.time() - start) / 60)
@@ -1,68 +1,124 @@
-import sys
-import os
-import math
-import argparse
-import tensorflow as tf 
-import numpy as np 
-import tools
-
-'''Generate, visualize, and save voxel shapes for nn training'''
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--size', type=int, default=32,
-                        help='Voxel dimensions cubed')
-    parser.add_argument('--amount', type=int, default=3, 
-                        help='The number of voxel shapes to generate')
-    parser.add_argument('--seed', type=int, default=None,
-                        help='tensorflow weight init seed')
-    args = parser.parse_args()
-    
-    for file in os.listdir(tools.get_path('shapes')):
-        os.remove(tools.get_path('shapes', file))
-    
-    make_shape(args)
-
-def gaussian(x):
-    sigma = 1
-    mean = 0
-    return (tf.exp((-(x-mean)**2) / (2 * sigma ** 2))) / (sigma * tf.sqrt(2 * math.pi))
-
-def make_shape(args):
-    tf.set_random_seed(args.seed)
-    tools.gen_coord_datasets()
-
-    # get dataset
-    xdata = tools.load_coord_dataset(args.size)
-    x = tf.placeholder(tf.float32, [None, 4])
-
-    for i in range(args.amount):
-        # cppn network graph
-        wrange = 2
-        w1 = tf.Variable(tf.random_uniform([4, 30], -wrange, wrange))
-        w2 = tf.Variable(tf.random_uniform([30, 30], -wrange, wrange))
-        w3 = tf.Variable(tf.random_uniform([30, 30], -wrange, wrange))
-        w4 = tf.Variable(tf.random_uniform([30, 30], -wrange, wrange))
-        w5 = tf.Variable(tf.random_uniform([30, 1], -wrange, wrange))
-
-        layer1 = gaussian(tf.matmul(x, w1))
-        layer2 = tf.sin(tf.matmul(layer1, w2))
-        layer3 = tf.nn.sigmoid(tf.matmul(layer2, w3))
-        layer4 = tf.tanh(tf.matmul(layer3, w4))
-        layer5 = tf.sigmoid(tf.matmul(layer4, w5))
-
-        # run cppn network for number of shapes
-        init = tf.global_variables_initializer()
-        with tf.Session() as sess:
-            sess.run(init)
-            outputs = sess.run(layer5, feed_dict={x: xdata})
-
-            voxels = np.rint(outputs).reshape(args.size, args.size, args.size)
-            voxels[voxels < 0] = 0
-            # save to shapes dir
-            path = tools.get_path('shapes', 'shape{}'.format(i))
-            np.save(path, voxels)
-            tools.render_voxels(voxels)
-
-if __name__ == '__main__':
-    main()
+import math
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tools
+import export
+import instrument
+from store import ShapeStore
+
+'''Generate, visualize, and save voxel shapes for nn training'''
+
+# cppn layer sizes, 4 coordinate inputs -> 4 hidden layers of 30 -> 1 output
+CPPN_LAYERS = (4, 30, 30, 30, 30, 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=32,
+                        help='Voxel dimensions cubed')
+    parser.add_argument('--amount', type=int, default=3,
+                        help='The number of voxel shapes to generate')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='weight init seed, shape i uses seed + i')
+    parser.add_argument('--batch', type=int, default=16,
+                        help='shapes evaluated together in one batched pass')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes evaluating batches, default runs in this process')
+    parser.add_argument('--render', type=int, default=-1,
+                        help='render the first RENDER shapes in the browser, -1 is all, 0 is headless')
+    parser.add_argument('--export', type=str, default=None,
+                        help='also write each shape mesh to this .ply | .stl | .glb | .obj path, numbered per shape')
+    parser.add_argument('--no_browser', action='store_true',
+                        help='render no shapes, same as --render 0')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='stages (timer and counter breakdown) | cprofile (dump newshape.prof)')
+    args = parser.parse_args()
+    if args.no_browser:
+        args.render = 0
+
+    instrument.run(lambda: make_shape(args), args.profile, 'newshape.prof')
+
+def gaussian(x):
+    sigma = 1
+    mean = 0
+    return (np.exp((-(x-mean)**2) / (2 * sigma ** 2))) / (sigma * np.sqrt(2 * math.pi))
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def cppn_weights(seeds, wrange=2):
+    '''Weights of one random cppn per seed, stacked along a leading batch axis:
+       a list of (len(seeds), n_in, n_out) float32 arrays, one per layer'''
+    rngs = [np.random.RandomState(seed) for seed in seeds]
+    return [np.stack([rng.uniform(-wrange, wrange, size=(n_in, n_out)) for rng in rngs]).astype(np.float32)
+            for n_in, n_out in zip(CPPN_LAYERS[:-1], CPPN_LAYERS[1:])]
+
+@instrument.timed('cppn')
+def cppn_batch(coords, weights, chunk=8192, threshold=0.5):
+    '''Evaluate a batch of cppns on (n, 4) coords with batched matmuls, chunk rows at a
+       time to bound the (batch, chunk, 30) hidden layers. Each chunk is thresholded
+       straight into the output, returns (batch, n) uint8 with 1 above threshold'''
+    w1, w2, w3, w4, w5 = weights
+    out = np.empty((len(w1), len(coords)), dtype=np.uint8)
+    for start in range(0, len(coords), chunk):
+        x = coords[start:start + chunk]
+        layer1 = gaussian(np.matmul(x, w1))
+        layer2 = np.sin(np.matmul(layer1, w2))
+        layer3 = sigmoid(np.matmul(layer2, w3))
+        layer4 = np.tanh(np.matmul(layer3, w4))
+        layer5 = sigmoid(np.matmul(layer4, w5))
+        out[:, start:start + chunk] = layer5[..., 0] > threshold
+    return out
+
+def shape_batch(size, seeds):
+    '''binary uint8 voxel grids (len(seeds), size, size, size) for one batch of cppn
+       seeds, rounded as np.rint would'''
+    coords = tools.load_coord_dataset(size)
+    return cppn_batch(coords, cppn_weights(seeds)).reshape(len(seeds), size, size, size)
+
+def generate_shapes(size, amount, seed=None, batch=16, workers=None):
+    '''Generator of (seed, voxels) for amount shapes in order, evaluated batch shapes at a
+       time, on a process pool when workers > 1. At most 2 * workers batches are in
+       flight, so a slow consumer does not pile up finished batches. Shape i comes from
+       seed + i, so a shape does not depend on the batch size or worker count'''
+    if seed is None:
+        seed = np.random.randint(2 ** 31 - amount)
+    seeds = list(range(seed, seed + amount))
+    batches = [seeds[start:start + batch] for start in range(0, amount, batch)]
+    if workers is not None and workers > 1:
+        # build the coordinate dataset once before the workers open it
+        tools.load_coord_dataset(size)
+        with ProcessPoolExecutor(workers) as pool:
+            # results are pulled in batch order
+            pending = deque()
+            for batch_seeds in batches:
+                pending.append((batch_seeds, pool.submit(shape_batch, size, batch_seeds)))
+                if len(pending) >= 2 * workers:
+                    batch_seeds, future = pending.popleft()
+                    yield from zip(batch_seeds, future.result())
+            while pending:
+                batch_seeds, future = pending.popleft()
+                yield from zip(batch_seeds, future.result())
+    else:
+        for batch_seeds in batches:
+            yield from zip(batch_seeds, shape_batch(size, batch_seeds))
+
+def make_shape(args):
+    start = time.time()
+    # bit packed shape store in the shapes dir, replaces the previous shapes
+    with ShapeStore.create() as store:
+        for i, (seed, voxels) in enumerate(generate_shapes(args.size, args.amount, args.seed,
+                                                           args.batch, args.workers)):
+            with instrument.timer('store'):
+                store.add(voxels, seed)
+            instrument.count('shapes generated')
+            if args.export:
+                export.export_voxels(voxels, export.numbered_path(args.export, i))
+            if args.render < 0 or i < args.render:
+                tools.render_voxels(voxels)
+    print('--> GENERATED {} shapes of {}^3 in {:0.2f}s'.format(args.amount, args.size, time.time() - start))
+
+if __name__ == '__main__':
+    main()
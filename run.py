@@ -2,51 +2,97 @@ import os
 import sys
 import argparse
 import time
-import tensorflow as tf 
+import tempfile
 import numpy as np 
 import tools
+import export
+import instrument
+from gridcache import GridCache
+from model import VoxelModel, slab_plan
 
 '''run the trained model on a specified latent vector to output
     the associated voxel shape'''
 
 def main(args):
 
-    np.random.seed(args.seed)
-    tf.set_random_seed(args.seed)
-
-    shape_amount = len(os.listdir(tools.get_path('shapes')))
-    vol = args.size ** 3
-    
-    # data
-    latent_vec = np.random.uniform(size=(shape_amount, 1))    
-    coord_vec = tools.load_coord_dataset(args.size)
-    xdata = np.append(coord_vec, latent_vec[args.shape] * np.ones((vol, 1)), axis=1)
+    # load the model, evaluated in numpy, a bundle carries its own latent vector
+    model = VoxelModel.load(args.model)
+    latent_vec = model.latent_vec(args.seed)
+    latent = latent_vec[args.shape, 0]
 
     print('latent vector input\n', latent_vec)
-    
-    # load the model
-    params = np.load('model.npy')
-
-    # model graph
-    x = tf.placeholder(tf.float32, [None, 5])
-    W = params[0]
-    B = params[1]
-    w1 = tf.constant(W[0])
-    w2 = tf.constant(W[1])
-    w3 = tf.constant(W[2])
-    b1 = tf.constant(B[0])
-    b2 = tf.constant(B[1])
-
-    hidden1 = tf.tanh(tf.matmul(x, w1) + b1)
-    hidden2 = tf.tanh(tf.matmul(hidden1, w2) + b2)    
-    output = tf.nn.sigmoid(tf.matmul(hidden2, w3))
-
-    with tf.Session() as sess:
-        pred = sess.run(output, feed_dict={x: xdata})
+
+    if args.budget_mb:
+        # the occupancy grid lives in a memory mapped file in the working dir
+        fd, grid_path = tempfile.mkstemp(suffix='.npy', dir='.')
+        os.close(fd)
+        try:
+            out_of_core(args, model, latent, grid_path)
+        finally:
+            os.remove(grid_path)
+        return
+
+    # dense grids and their meshes are cached on disk across runs
+    cache = GridCache(max_bytes=args.cache_mb * 2 ** 20, workers=args.workers) if args.cache_mb else None
+    mesh = None
+    # smooth meshes the probability field itself at the iso-level
+    level = args.level if args.mesh == 'smooth' else None
+    if level is not None:
+        coord_vec = tools.load_coord_dataset(args.size)
+        voxels = model.probabilities(coord_vec, latent, args.size, workers=args.workers)
+    elif args.eval == 'adaptive':
+        # coarse to fine, only evaluates the network near the surface
+        voxels, evaluated = model.adaptive_voxels(args.size, latent)
+        print('--> EVALUATED {} of {} voxels'.format(evaluated, voxels.size))
+    elif args.eval == 'check':
+        coord_vec = tools.load_coord_dataset(args.size)
+        model.compare_adaptive(coord_vec, latent, args.size)
+        pred = model.predict(coord_vec, latent, workers=args.workers)
+        voxels = np.rint(pred).reshape(args.size, args.size, args.size)
+    elif cache is not None:
+        voxels, mesh = cache.grid(model, latent, args.size, greedy=args.mesh != 'naive')
+        cache.report()
+    else:
+        coord_vec = tools.load_coord_dataset(args.size)
+        voxels = model.voxels(coord_vec, latent, args.size, workers=args.workers)
+
+    if args.export:
+        if mesh is not None:
+            export.export_mesh(args.export, [mesh])
+        else:
+            export.export_voxels(voxels, args.export, greedy=args.mesh != 'naive', level=level)
+    if args.no_browser:
+        return
 
     # render in browser
-    voxels = np.rint(pred).reshape(args.size, args.size, args.size)
-    tools.render_voxels(voxels)
+    if args.mesh == 'compare':
+        tools.compare_meshers(voxels)
+    if args.payload == 'compare':
+        tools.compare_payloads([tools.mesh_grid(voxels, args.mesh != 'naive', level)])
+        args.payload = 'base64'
+    tools.render_voxels(voxels, greedy=args.mesh != 'naive', payload=args.payload, mesh=mesh, level=level)
+
+def mesh_plan(size, budget):
+    '''(slab layers, max faces) of out of core meshing. Half the budget holds the faces of
+       one mesh chunk, at least a row of cells worth, the rest the slab, which also reads
+       one overlap layer on each side'''
+    max_faces = max(budget // 2 // tools.MESH_FACE_BYTES, 6 * size)
+    reserve = 2 * size * size * tools.SLAB_MESH_BYTES + max_faces * tools.MESH_FACE_BYTES
+    return tools.slab_layers(size, budget, tools.SLAB_MESH_BYTES, reserve), max_faces
+
+def out_of_core(args, model, latent, grid_path):
+    '''evaluate, mesh and export slab by slab, peak memory stays within --budget_mb'''
+    budget = args.budget_mb * 2 ** 20
+    slab, max_faces = mesh_plan(args.size, budget)
+    voxels = model.voxels_out_of_core(latent, args.size, grid_path, budget, workers=args.workers)
+    greedy = args.mesh != 'naive'
+    if args.export:
+        export.export_voxels(voxels, args.export, greedy, slab, max_faces=max_faces)
+    if args.no_browser:
+        return
+    # the viewer page needs the whole mesh, only the grid stays out of core
+    mesh = tools.join_chunks(tools.iter_mesh_chunks(voxels, greedy, slab, max_faces))
+    tools.render_voxels(voxels, greedy, args.payload, mesh=mesh)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -55,7 +101,38 @@ if __name__ == '__main__':
     parser.add_argument('--size', type=int, default=32, 
                         help='Voxel dimensions cubed, can be different size for train vs latent op')
     parser.add_argument('--seed', type=int, default=256,
-                        help='latent vector seed')
+                        help='latent vector seed, only used for legacy model.npy files')
+    parser.add_argument('--model', type=str, default='model.npz',
+                        help='model bundle written by net.py, or a legacy model.npy')
+    parser.add_argument('--eval', type=str, default='dense',
+                        help='network evaluation: dense | adaptive | check (report adaptive mismatch, render dense)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='threads used to evaluate the network')
+    parser.add_argument('--mesh', type=str, default='naive',
+                        help='mesher: naive | greedy | smooth (iso-surface of the probabilities) | compare (report both, render greedy)')
+    parser.add_argument('--level', type=float, default=0.5,
+                        help='iso-level of the probability field meshed by --mesh smooth')
+    parser.add_argument('--payload', type=str, default='base64',
+                        help='viewer mesh format: base64 | bin | json | compare (report all, write base64)')
+    parser.add_argument('--cache_mb', type=int, default=256,
+                        help='size cap of the on disk grid and mesh cache in MB, 0 turns it off')
+    parser.add_argument('--budget_mb', type=int, default=0,
+                        help='evaluate and mesh out of core in slabs fitting this many MB, 0 is in memory')
+    parser.add_argument('--export', type=str, default=None,
+                        help='also write the mesh to this .ply | .stl | .glb | .obj file')
+    parser.add_argument('--no_browser', action='store_true',
+                        help='skip the viewer page and browser, e.g. on headless hosts')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='stages (timer and counter breakdown) | cprofile (dump run.prof)')
+    args = parser.parse_args()
+    if args.budget_mb and (args.mesh in ('smooth', 'compare') or args.payload == 'compare'):
+        parser.error('--budget_mb supports --mesh naive | greedy and no payload compare')
+    if args.budget_mb:
+        try:
+            mesh_plan(args.size, args.budget_mb * 2 ** 20)
+            slab_plan(args.size, args.budget_mb * 2 ** 20, workers=args.workers)
+        except ValueError as e:
+            parser.error('--budget_mb: {}'.format(e))
     start = time.time()
-    main(parser.parse_args())
+    instrument.run(lambda: main(args), args.profile, 'run.prof')
     print('time (min)', (time.time() - start) / 60)
\ No newline at end of file
@@ -0,0 +1,271 @@
+import argparse
+import struct
+import threading
+import time
+import webbrowser
+from collections import OrderedDict
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from jinja2 import Template
+import tools
+from model import VoxelModel
+
+'''Local latent space explorer: serves meshes of the trained model on demand to a
+   slider viewer page, the model is loaded once and meshes are kept in an LRU cache'''
+
+class MeshCache:
+    '''Meshes of the model keyed by (quantized latent, size, greedy), the entries most
+       recently used are kept. A latent is snapped to a multiple of quantum before it
+       is evaluated, so every request that shares a key gets the same mesh'''
+
+    def __init__(self, model, entries=64, quantum=1e-3):
+        self.model = model
+        self.entries = entries
+        self.quantum = quantum
+        self.meshes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # evaluate one mesh at a time, so concurrent requests never each hold a full grid
+        self.lock = threading.Lock()
+
+    def key(self, latent, size, greedy):
+        return int(round(latent / self.quantum)), size, greedy
+
+    def get(self, latent, size, greedy=False):
+        '''encoded mesh bytes for a latent value and size, and whether it was cached'''
+        key = self.key(latent, size, greedy)
+        with self.lock:
+            if key in self.meshes:
+                self.meshes.move_to_end(key)
+                self.hits += 1
+                return self.meshes[key], True
+            self.misses += 1
+            voxels = self.model.voxels(tools.load_coord_dataset(size), key[0] * self.quantum, size)
+            data = encode_mesh(*tools.mesh_arrays(voxels, greedy))
+            self.meshes[key] = data
+            while len(self.meshes) > self.entries:
+                self.meshes.popitem(last=False)
+            return data, False
+
+def encode_mesh(verts, faces):
+    '''Binary mesh response read by VoxMesh.decode_mesh: uint32 position and index
+       counts followed by the little endian float32 positions and uint32 index'''
+    positions, index = tools.mesh_buffers(verts, faces)
+    return b''.join([struct.pack('<II', positions.size, index.size),
+                     positions.astype('<f4').tobytes(), index.astype('<u4').tobytes()])
+
+class ViewerHandler(SimpleHTTPRequestHandler):
+    '''/ is the slider viewer, /mesh?latent=..&size=..&greedy=.. a binary mesh, anything
+       else a static file from the templates dir (three.js, voxmesh.js, css)'''
+
+    def __init__(self, *args, cache=None, page=None, max_size=256, **kwargs):
+        self.cache = cache
+        self.page = page
+        self.max_size = max_size
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/':
+            self.send_body(self.page, 'text/html; charset=utf-8')
+        elif url.path == '/mesh':
+            self.send_mesh(parse_qs(url.query))
+        else:
+            super().do_GET()
+
+    def send_mesh(self, query):
+        try:
+            latent = float(query['latent'][0])
+            size = int(query.get('size', ['32'])[0])
+            greedy = query.get('greedy', ['0'])[0] == '1'
+        except (KeyError, ValueError):
+            self.send_error(400, 'expected /mesh?latent=FLOAT&size=INT&greedy=0|1')
+            return
+        if not 4 <= size <= self.max_size or not np.isfinite(latent):
+            self.send_error(400, 'size must be in 4..{} and latent finite'.format(self.max_size))
+            return
+        start = time.time()
+        data, hit = self.cache.get(latent, size, greedy)
+        print('--> MESH latent {:0.4f} size {} greedy {}: {} bytes, {} in {:0.3f}s ({} hits, {} misses)'.format(
+              latent, size, greedy, len(data), 'hit' if hit else 'miss', time.time() - start,
+              self.cache.hits, self.cache.misses))
+        self.send_body(data, 'application/octet-stream', {'X-Cache': 'hit' if hit else 'miss'})
+
+    def send_body(self, data, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # mesh requests print their own line
+        pass
+
+SLIDER_HTML = Template('''<html>
+            <head>
+                <title>Latent explorer</title>
+                <meta charset="utf-8">
+                <meta name="viewport" content="width=device-width, user-scalable=no, minimum-scale=1.0, maximum-scale=1.0">
+                <link rel="stylesheet" type="text/css" href="css/styles1.css"/>
+            </head>
+            <body>
+                <canvas id="canvas"></canvas>
+                <div id="top_panel"></div>
+                <div id="bottom_panel">
+                    <input id="latent" type="range" min="{{lmin}}" max="{{lmax}}" step="{{step}}" value="{{lmin}}"
+                           style="width: 60%; margin: 14px 10px;">
+                    <select id="size" class="controls">
+                        {% for s in sizes %}<option value="{{s}}" {% if s == size %}selected{% endif %}>{{s}}</option>{% endfor %}
+                    </select>
+                    <span id="status" style="color: #e0e3e5; font-family: sans-serif;"></span>
+                </div>
+
+                <script src="js/three.min.js"></script>
+                <script src="js/OrbitControls.js"></script>
+                <script src="js/voxmesh.js"></script>
+
+                <script>
+                    var renderer = new THREE.WebGLRenderer({canvas: document.getElementById('canvas'), antialias: true});
+                    var camera = new THREE.PerspectiveCamera(70, window.innerWidth / window.innerHeight, 0.1, 10000);
+                    var scene = new THREE.Scene();
+
+                    renderer.setClearColor(0x37373B);
+                    renderer.setSize(window.innerWidth, window.innerHeight);
+                    renderer.setPixelRatio(window.devicePixelRatio);
+
+                    //scene and camera setup
+                    camera.position.set(-200, 200, -200);
+                    camera.up = new THREE.Vector3(0, 1, 0);
+                    camera.lookAt(new THREE.Vector3(0, 0, 0))
+                    scene.add(camera);
+
+                    //controls
+                    var controls = new THREE.OrbitControls(camera, renderer.domElement);
+                    controls.target.set(0, 0, 0);
+                    controls.update();
+                    controls.maxDistance = 2000;
+                    controls.zoomSpeed = 0.5;
+                    controls.enablePan = true;
+                    controls.rotateSpeed = 0.5;
+
+                    //lights
+                    scene.add(new THREE.AmbientLight(0xffffff, 1.0));
+                    var light2 = new THREE.PointLight(0xff3333, 0.75);
+                    light2.position.set(-100, 200, -500);
+                    scene.add(light2);
+                    scene.add(new THREE.PointLight(0x3333ff, 0.75));
+                    var light3 = new THREE.SpotLight(0xddddff, 1);
+                    light3.position.set(-300, -300, 300);
+                    scene.add(light3);
+
+                    window.addEventListener('resize', function(){
+                        camera.aspect = window.innerWidth / window.innerHeight;
+                        camera.updateProjectionMatrix();
+                        renderer.setSize(window.innerWidth, window.innerHeight);
+                    }, false);
+
+                    function render() {
+                        requestAnimationFrame(render);
+                        renderer.render(scene, camera);
+                    }
+
+                    var material = new THREE.MeshLambertMaterial({color: 0x616c72});
+                    var plane = new THREE.Mesh(new THREE.PlaneGeometry(200, 200), new THREE.MeshLambertMaterial({
+                                color: 0xe0e3e5, transparent: true, opacity: 0.7, side: THREE.DoubleSide}));
+                    plane.rotateX(Math.PI / 2);
+                    scene.add(plane);
+
+                    var slider = document.getElementById('latent');
+                    var select = document.getElementById('size');
+                    var status = document.getElementById('status');
+                    var voxmesh = null;
+                    // only the latest requested frame is shown, requests are made one at a time
+                    var busy = false;
+                    var wanted = null;
+
+                    function request(){
+                        if (busy || wanted === null) return;
+                        var query = wanted;
+                        wanted = null;
+                        busy = true;
+                        var xhr = new XMLHttpRequest();
+                        xhr.open('GET', 'mesh?' + query, true);
+                        xhr.responseType = 'arraybuffer';
+                        xhr.onload = function(){
+                            busy = false;
+                            if (xhr.status == 200){
+                                var size = parseInt(select.value);
+                                var data = VoxMesh.decode_mesh(xhr.response);
+                                if (voxmesh !== null){
+                                    scene.remove(voxmesh);
+                                    voxmesh.geometry.dispose();
+                                }
+                                voxmesh = new THREE.Mesh(VoxMesh.build_geometry(data[0], data[1]), material);
+                                voxmesh.position.set(-size, size / 2, -size);
+                                scene.add(voxmesh);
+                                status.textContent = query + ' (' + xhr.getResponseHeader('X-Cache') + ')';
+                            }
+                            request();
+                        };
+                        xhr.send();
+                    }
+
+                    function update(){
+                        wanted = 'latent=' + slider.value + '&size=' + select.value;
+                        request();
+                    }
+
+                    slider.addEventListener('input', update);
+                    select.addEventListener('change', update);
+                    update();
+                    render();
+                </script>
+            </body>
+        </html>''')
+
+def main(args):
+    model = VoxelModel.load(args.model)
+    latent_vec = model.latent_vec(args.seed)
+    lmin, lmax = float(np.amin(latent_vec)), float(np.amax(latent_vec))
+    cache = MeshCache(model, args.cache, args.quantum)
+    sizes = [s for s in (16, 32, 48, 64, 96, 128, 192, 256) if s <= args.max_size]
+    page = SLIDER_HTML.render(lmin=lmin, lmax=lmax, step=args.quantum, sizes=sizes,
+                              size=args.size).encode('utf8')
+    handler = partial(ViewerHandler, cache=cache, page=page, max_size=args.max_size,
+                      directory=tools.get_path('templates'))
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    print('--> SERVING latent {:0.3f}..{:0.3f} on {}'.format(lmin, lmax, url))
+    if not args.no_browser:
+        webbrowser.open(url, new=2)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='model.npz',
+                        help='model bundle written by net.py, or a legacy model.npy')
+    parser.add_argument('--seed', type=int, default=256,
+                        help='latent vector seed, only used for legacy model.npy files')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='localhost port to serve on')
+    parser.add_argument('--size', type=int, default=32,
+                        help='initial voxel dimensions cubed')
+    parser.add_argument('--max_size', type=int, default=128,
+                        help='largest size a request may ask for')
+    parser.add_argument('--cache', type=int, default=64,
+                        help='meshes kept in the LRU cache')
+    parser.add_argument('--quantum', type=float, default=1e-3,
+                        help='latent values are snapped to multiples of this, also the slider step')
+    parser.add_argument('--no_browser', action='store_true',
+                        help='only print the address, do not open a browser')
+    main(parser.parse_args())
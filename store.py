@@ -0,0 +1,137 @@
+import os
+import re
+import shutil
+import numpy as np
+import tools
+
+'''Bit packed shape archive replacing the per shape shapes/shape{i}.npy files'''
+
+# one row per stored shape, offset is the byte offset of its packed bits in shapes.bin
+INDEX_DTYPE = np.dtype([('id', '<i8'), ('size', '<i4'), ('seed', '<i8'),
+                        ('voxels', '<i8'), ('offset', '<i8')])
+
+def packed_bytes(size):
+    '''bytes of one packed size ** 3 shape'''
+    return (size ** 3 + 7) // 8
+
+class ShapeStore:
+    '''Binary voxel shapes packed 8 per byte into one shapes.bin file with an index.npy
+       of (id, size, seed, voxel count, offset) rows, in a shapes directory. Shapes are
+       read through a read only memory map, so only the accessed shapes are paged in.
+
+       store = ShapeStore.create()
+       store.add(voxels, seed)
+       store.close()
+       voxels = ShapeStore.open()[0]'''
+
+    def __init__(self, dirname='shapes'):
+        self.dirname = dirname
+        self.bits_path = tools.get_path(dirname, 'shapes.bin')
+        self.index_path = tools.get_path(dirname, 'index.npy')
+        if os.path.exists(self.index_path):
+            self.index = np.load(self.index_path, allow_pickle=False)
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        self.rows = list(self.index)
+        self.file = None
+        self.mmap = None
+
+    @classmethod
+    def create(cls, dirname='shapes'):
+        '''empty store, any shapes, legacy files or unfinished migrations in dirname are removed'''
+        for file in os.listdir(tools.get_path(dirname)):
+            path = tools.get_path(dirname, file)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        return cls(dirname)
+
+    @classmethod
+    def open(cls, dirname='shapes'):
+        '''existing store, a legacy directory of shape{i}.npy files is migrated first'''
+        if legacy_files(dirname):
+            migrate(dirname)
+        return cls(dirname)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        '''uint8 (size, size, size) occupancy of shape i'''
+        size = int(self.index[i]['size'])
+        return np.unpackbits(self.packed(i), count=size ** 3).reshape(size, size, size)
+
+    def packed(self, i):
+        '''memory mapped packed bits of shape i, as written by np.packbits of the flat grid'''
+        row = self.index[i]
+        if self.mmap is None:
+            self.mmap = np.memmap(self.bits_path, dtype=np.uint8, mode='r')
+        return self.mmap[row['offset']:row['offset'] + packed_bytes(int(row['size']))]
+
+    def packed_array(self, size):
+        '''(len, packed_bytes(size)) packed bits of every shape, all of the same size'''
+        if np.any(self.index['size'] != size):
+            raise ValueError('shape store {} holds sizes {}, expected {}'.format(
+                             self.dirname, sorted(set(self.index['size'].tolist())), size))
+        return np.stack([self.packed(i) for i in range(len(self))])
+
+    def add(self, voxels, seed=-1):
+        '''append a binary (size, size, size) grid, the index is written on close'''
+        voxels = np.asarray(voxels)
+        occupied = voxels.reshape(-1) > 0.5
+        bits = np.packbits(occupied)
+        if self.file is None:
+            self.file = open(self.bits_path, 'ab')
+        offset = self.file.tell()
+        self.file.write(bits.tobytes())
+        self.rows.append((len(self.rows), voxels.shape[0], seed, np.count_nonzero(occupied), offset))
+        return len(self.rows) - 1
+
+    def close(self):
+        '''flush appended shapes and atomically replace the index'''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.index = np.array([tuple(row) for row in self.rows], dtype=INDEX_DTYPE)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.index)
+        os.replace(tmp_path, self.index_path)
+        self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            # keep the last written index, bits appended since are not referenced by it
+            self.file.close()
+            self.file = None
+
+def legacy_files(dirname='shapes'):
+    '''shape{i}.npy files of the old directory layout, sorted by i'''
+    names = [f for f in os.listdir(tools.get_path(dirname)) if re.match(r'shape\d+\.npy$', f)]
+    return sorted(names, key=lambda f: int(f[5:-4]))
+
+def migrate(dirname='shapes'):
+    '''Pack the legacy shape{i}.npy files of dirname into a shape store, keeping their
+       order, and remove them. Their seeds are unknown and stored as -1.
+       The store is built in a migrating sub directory and moved into place once every
+       file is added, so an interrupted migration leaves the legacy files as they were
+       and the next one starts over'''
+    names = legacy_files(dirname)
+    tmp_dir = os.path.join(dirname, 'migrating')
+    with ShapeStore.create(tmp_dir) as store:
+        for name in names:
+            store.add(np.load(tools.get_path(dirname, name)))
+    # the legacy files stay until both are in place, open migrates again after a crash here
+    for fname in ('shapes.bin', 'index.npy'):
+        os.replace(tools.get_path(tmp_dir, fname), tools.get_path(dirname, fname))
+    os.rmdir(tools.get_path(tmp_dir))
+    for name in names:
+        os.remove(tools.get_path(dirname, name))
+    print('--> MIGRATED {} shapes in {} to shapes.bin'.format(len(names), dirname))
+    return ShapeStore(dirname)
@@ -0,0 +1,125 @@
+// decode mesh payloads written by tools.py into three.js BufferGeometry
+// payload = {format: 'base64' | 'bin' | 'json', bin: 'file.bin', frames: [{verts: .., index: ..}]}
+//   base64: verts and index are base64 strings of float32 / uint32 little endian buffers
+//   bin:    verts and index are [byte offset, element count] into the side-car bin file
+//   json:   verts and index are flat number lists
+// payload.delta = true: frames are {verts, add, remove} from tools.delta_frames, verts holds
+//   the quads (4 verts in winding order) of new face slots, add and remove are uint32 slot ids
+var VoxMesh = {
+
+    decode_base64: function(str){
+        var bin = atob(str);
+        var bytes = new Uint8Array(bin.length);
+        for (var i = 0; i < bin.length; i++){
+            bytes[i] = bin.charCodeAt(i);
+        }
+        return bytes.buffer;
+    },
+
+    decode_array: function(payload, data, type, buffer){
+        if (payload.format == 'json'){
+            return new type(data);
+        } else if (payload.format == 'base64'){
+            return new type(VoxMesh.decode_base64(data));
+        }
+        return new type(buffer, data[0], data[1]);
+    },
+
+    decode_frame: function(payload, frame, buffer){
+        return [VoxMesh.decode_array(payload, frame.verts, Float32Array, buffer),
+                VoxMesh.decode_array(payload, frame.index, Uint32Array, buffer)];
+    },
+
+    // one geometry per delta frame, all sharing the position and normal attributes
+    // of every face slot in the animation
+    build_delta: function(payload, buffer){
+        var frames = [];
+        var total = 0;
+        for (var j = 0; j < payload.frames.length; j++){
+            var frame = payload.frames[j];
+            var verts = VoxMesh.decode_array(payload, frame.verts, Float32Array, buffer);
+            frames.push([verts, VoxMesh.decode_array(payload, frame.add, Uint32Array, buffer),
+                         VoxMesh.decode_array(payload, frame.remove, Uint32Array, buffer)]);
+            total += verts.length;
+        }
+        var positions = new Float32Array(total);
+        var offset = 0;
+        for (var j = 0; j < frames.length; j++){
+            positions.set(frames[j][0], offset);
+            offset += frames[j][0].length;
+        }
+        var slots = total / 12;
+        function quads(active, count){
+            var index = new Uint32Array(count * 6);
+            var n = 0;
+            for (var s = 0; s < slots; s++){
+                if (!active[s]) continue;
+                var v = s * 4;
+                index.set([v, v + 1, v + 2, v + 2, v + 3, v], n);
+                n += 6;
+            }
+            return index;
+        }
+        // normals once over every slot, quads do not share verts
+        var all = new Uint8Array(slots).fill(1);
+        var full = VoxMesh.build_geometry(positions, quads(all, slots));
+        var geometries = [];
+        var active = new Uint8Array(slots);
+        var count = 0;
+        for (var j = 0; j < frames.length; j++){
+            var add = frames[j][1], remove = frames[j][2];
+            for (var i = 0; i < remove.length; i++){ active[remove[i]] = 0; }
+            for (var i = 0; i < add.length; i++){ active[add[i]] = 1; }
+            count += add.length - remove.length;
+            var geometry = new THREE.BufferGeometry();
+            geometry.setIndex(new THREE.BufferAttribute(quads(active, count), 1));
+            geometry.addAttribute('position', full.getAttribute('position'));
+            geometry.addAttribute('normal', full.getAttribute('normal'));
+            geometry.computeBoundingSphere();
+            geometries.push(geometry);
+        }
+        return geometries;
+    },
+
+    // binary mesh from server.py: uint32 position and index counts, then the buffers
+    decode_mesh: function(buffer){
+        var counts = new Uint32Array(buffer, 0, 2);
+        return [new Float32Array(buffer, 8, counts[0]),
+                new Uint32Array(buffer, 8 + counts[0] * 4, counts[1])];
+    },
+
+    build_geometry: function(verts, index){
+        var geometry = new THREE.BufferGeometry();
+        geometry.setIndex(new THREE.BufferAttribute(index, 1));
+        geometry.addAttribute('position', new THREE.BufferAttribute(verts, 3));
+        geometry.computeBoundingSphere();
+        geometry.computeVertexNormals();
+        return geometry;
+    },
+
+    // calls back with one BufferGeometry per frame, the bin format is fetched
+    // so the page has to be served over http for it
+    load: function(payload, callback){
+        function build(buffer){
+            if (payload.delta){
+                callback(VoxMesh.build_delta(payload, buffer));
+                return;
+            }
+            var geometries = [];
+            for (var j = 0; j < payload.frames.length; j++){
+                var data = VoxMesh.decode_frame(payload, payload.frames[j], buffer);
+                geometries.push(VoxMesh.build_geometry(data[0], data[1]));
+            }
+            callback(geometries);
+        }
+        if (payload.format != 'bin'){
+            build(null);
+            return;
+        }
+        var request = new XMLHttpRequest();
+        request.open('GET', payload.bin, true);
+        request.responseType = 'arraybuffer';
+        request.onload = function(){ build(request.response); };
+        request.send();
+    }
+};
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import bench
+import export
+import run
+import tools
+from model import VoxelModel, slab_plan
+
+MB = 2 ** 20
+
+def random_model(seed):
+    rng = np.random.RandomState(seed)
+    weights = [rng.uniform(-2, 2, size=s) for s in ((5, 10), (10, 10), (10, 1))]
+    biases = [rng.uniform(-1, 1, size=10) for _ in range(2)]
+    weights[2] *= 5
+    return VoxelModel(weights, biases)
+
+def checkerboard(size):
+    i, j, k = np.indices((size,) * 3, dtype=np.uint16)
+    return ((i + j + k) % 2).astype(np.uint8)
+
+def peak_delta(fn):
+    '''peak RSS above the current RSS while fn runs, skips where /proc is not available'''
+    if not bench.reset_peak_rss() or bench.rss_status('VmHWM') is None:
+        pytest.skip('peak RSS needs linux /proc')
+    base = bench.rss_status('VmRSS')
+    bench.reset_peak_rss()
+    fn()
+    return bench.rss_status('VmHWM') - base
+
+def test_out_of_core_evaluation_stays_within_budget(tmp_path):
+    model = random_model(0)
+    budget = 32 * MB
+    path = str(tmp_path / 'grid.npy')
+    # warm up numpy and the model so only the slabs are measured
+    model.voxels_out_of_core(0.5, 16, path, budget)
+    assert peak_delta(lambda: model.voxels_out_of_core(0.5, 256, path, budget)) <= budget
+    coords = tools.fill_coord_slab(256, 120, 124, np.empty((4 * 256 * 256, 4), dtype=np.float32))
+    expected = (model.predict(coords, 0.5) > 0.5).reshape(4, 256, 256)
+    assert np.array_equal(np.load(path, mmap_mode='r')[120:124], expected)
+
+def quad_areas(verts, faces):
+    quads = verts[faces.astype(np.int64)].astype(np.float64)
+    return np.linalg.norm(np.cross(quads[:, 2] - quads[:, 0], quads[:, 3] - quads[:, 1]), axis=1) / 2
+
+@pytest.mark.parametrize('greedy', [False, True])
+def test_dense_surface_mesh_chunks_are_bounded(greedy):
+    # a checkerboard has about three faces per voxel, the solid block gives greedy runs
+    grid = checkerboard(24)
+    grid[4:20, 4:20, 4:12] = 1
+    chunks = list(tools.iter_mesh_chunks(grid, greedy, slab=8, max_faces=300))
+    assert max(len(faces) for verts, faces in chunks) <= 300
+    verts, faces = tools.join_chunks(chunks)
+    whole_verts, whole_faces = tools.mesh_arrays(grid, greedy)
+    if greedy:
+        # blocks cut some rectangles, the surface stays the same
+        assert len(faces) >= len(whole_faces)
+        assert quad_areas(verts, faces).sum() == quad_areas(whole_verts, whole_faces).sum()
+    else:
+        quads = np.sort(verts[faces.astype(np.int64)].reshape(len(faces), -1), axis=0)
+        whole = np.sort(whole_verts[whole_faces.astype(np.int64)].reshape(len(whole_faces), -1), axis=0)
+        assert np.array_equal(quads, whole)
+
+def test_checkerboard_export_stays_within_budget(tmp_path):
+    size, budget = 96, 8 * MB
+    path = str(tmp_path / 'grid.npy')
+    np.save(path, checkerboard(size))
+    grid = tools.GridFile(path)
+    slab, max_faces = run.mesh_plan(size, budget)
+    export.export_voxels(checkerboard(8), str(tmp_path / 'warm.stl'))
+    out = str(tmp_path / 'shape.stl')
+    assert peak_delta(lambda: export.export_voxels(grid, out, False, slab, max_faces=max_faces)) <= budget
+
+def test_plans_reject_budgets_that_cannot_fit():
+    with pytest.raises(ValueError):
+        slab_plan(1024, 8 * MB)
+    with pytest.raises(ValueError):
+        run.mesh_plan(1024, 8 * MB)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import tools
+
+def reference_coords(size):
+    '''the original per voxel loop generate_coords was vectorized from'''
+    x_points, y_points, z_points = np.meshgrid(np.arange(size), np.arange(size), np.arange(size))
+    center = size / 2
+    tmp = []
+    for i in range(size):
+        for j in range(size):
+            for k in range(size):
+                dx, dy, dz = x_points[i, j, k], y_points[i, j, k], z_points[i, j, k]
+                tmp.append([dx, dy, dz, np.sqrt((dx - center) ** 2 + (dy - center) ** 2 + (dz - center) ** 2)])
+    data = np.array(tmp, dtype=np.float32)
+    data_min, data_max = np.amin(data), np.amax(data)
+    return (data - data_min) / (data_max - data_min)
+
+@pytest.mark.parametrize('size', [8, 15, 16, 32, 64])
+def test_generate_coords_matches_loop(size):
+    expected = reference_coords(size)
+    assert np.array_equal(tools.generate_coords(size), expected)
+    # slab sizes that do not divide the grid
+    assert np.array_equal(tools.generate_coords(size, slab=3), expected)
+
+@pytest.mark.parametrize('size', [8, 15, 64])
+def test_iter_coord_slabs_matches_loop(size):
+    expected = reference_coords(size)
+    slabs = [coords for _, _, coords in tools.iter_coord_slabs(size, slab=5)]
+    assert np.array_equal(np.concatenate(slabs), expected)
+
+@pytest.mark.parametrize('size', [8, 15, 32])
+def test_grid_coords_matches_loop(size):
+    expected = reference_coords(size)
+    index = np.random.RandomState(size).randint(0, size, size=(500, 3))
+    rows = index[:, 0] * size * size + index[:, 1] * size + index[:, 2]
+    assert np.array_equal(tools.grid_coords(size, index), expected[rows])
@@ -0,0 +1,60 @@
+import json
+import struct
+import numpy as np
+import export
+
+def read_glb(path):
+    '''(gltf json, binary chunk or None) of a glb file, checking the container layout'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, total = struct.unpack_from('<4sII', data)
+    assert (magic, version, total) == (b'glTF', 2, len(data))
+    length, kind = struct.unpack_from('<I4s', data, 12)
+    assert kind == b'JSON' and length % 4 == 0
+    gltf = json.loads(data[20:20 + length])
+    rest = data[20 + length:]
+    if not rest:
+        return gltf, None
+    length, kind = struct.unpack_from('<I4s', rest)
+    assert kind == b'BIN\x00' and length == len(rest) - 8
+    return gltf, rest[8:]
+
+def check_gltf(gltf, binary):
+    '''the glTF 2.0 schema rules a mesh export can break'''
+    assert gltf['asset']['version'] == '2.0'
+    assert 0 <= gltf['scene'] < len(gltf['scenes'])
+    for scene in gltf['scenes']:
+        assert scene.get('nodes', [0])
+    for key in ('buffers', 'bufferViews', 'accessors', 'meshes', 'nodes'):
+        assert gltf.get(key, [None]), key
+    for buffer in gltf.get('buffers', []):
+        assert buffer['byteLength'] >= 1
+        assert binary is not None and len(binary) >= buffer['byteLength']
+    for view in gltf.get('bufferViews', []):
+        assert view['byteLength'] >= 1
+        assert view['byteOffset'] + view['byteLength'] <= gltf['buffers'][view['buffer']]['byteLength']
+    for accessor in gltf.get('accessors', []):
+        assert accessor['count'] >= 1
+    if 'buffers' not in gltf:
+        assert binary is None
+
+def test_glb_empty_mesh_is_valid(tmp_path):
+    path = str(tmp_path / 'empty.glb')
+    assert export.export_voxels(np.zeros((8, 8, 8)), path) == (0, 0)
+    gltf, binary = read_glb(path)
+    check_gltf(gltf, binary)
+    assert 'meshes' not in gltf and binary is None
+
+def test_glb_mesh_round_trip(tmp_path):
+    voxels = np.zeros((8, 8, 8))
+    voxels[2:5, 3:6, 2:4] = 1
+    path = str(tmp_path / 'box.glb')
+    nverts, nfaces = export.export_voxels(voxels, path, greedy=True, slab=2)
+    gltf, binary = read_glb(path)
+    check_gltf(gltf, binary)
+    positions = np.frombuffer(binary[:nverts * 12], dtype='<f4').reshape(-1, 3)
+    index = np.frombuffer(binary[nverts * 12:], dtype='<u4')
+    assert gltf['accessors'][0]['count'] == nverts and len(index) == nfaces * 6
+    assert index.max() < nverts
+    assert np.allclose(positions.min(axis=0), gltf['accessors'][0]['min'])
+    assert np.allclose(positions.max(axis=0), gltf['accessors'][0]['max'])
@@ -0,0 +1,32 @@
+import numpy as np
+import tools
+from gridcache import GridCache
+from model import VoxelModel
+
+def random_model(seed):
+    rng = np.random.RandomState(seed)
+    weights = [rng.uniform(-2, 2, size=s) for s in ((5, 10), (10, 10), (10, 1))]
+    biases = [rng.uniform(-1, 1, size=10) for _ in range(2)]
+    # a large last layer so the grids are far from empty and differ between models
+    weights[2] *= 5
+    return VoxelModel(weights, biases)
+
+def test_cache_never_serves_another_models_grid(tmp_path):
+    cache = GridCache(str(tmp_path))
+    coords = tools.load_coord_dataset(16)
+    # short lived models, CPython reuses the address of a collected model for a new one
+    for seed in range(6):
+        model = random_model(seed)
+        voxels = cache.voxels(model, 0.3, 16)
+        assert np.array_equal(voxels, model.voxels(coords, 0.3, 16))
+        del model
+    assert cache.misses == 6 and cache.hits == 0
+
+def test_cache_hits_for_an_equal_model(tmp_path):
+    cache = GridCache(str(tmp_path))
+    first = cache.voxels(random_model(0), 0.3, 16)
+    second, mesh = cache.grid(random_model(0), 0.3, 16, greedy=True)
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert np.array_equal(first, second)
+    verts, faces = tools.mesh_arrays(second, True)
+    assert np.array_equal(mesh[0], verts) and np.array_equal(mesh[1], faces)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import tools
+
+FACE_OFFSETS = [[(0, 2, 2), (0, 0, 2), (2, 2, 2), (2, 0, 2)],
+                [(0, 0, 0), (2, 0, 0), (0, 0, 2), (2, 0, 2)],
+                [(0, 2, 0), (0, 0, 0), (2, 2, 0), (2, 0, 0)],
+                [(0, 2, 0), (2, 2, 0), (0, 2, 2), (2, 2, 2)],
+                [(2, 2, 0), (2, 0, 0), (2, 2, 2), (2, 0, 2)],
+                [(0, 2, 0), (0, 0, 0), (0, 2, 2), (0, 0, 2)]]
+FACE_WINDING = [[0, 1, 3, 2], [0, 1, 3, 2], [1, 0, 2, 3], [1, 0, 2, 3], [1, 0, 2, 3], [0, 1, 3, 2]]
+
+def reference_quads(bin_array):
+    '''the original per voxel np2vox loop mesh_arrays was vectorized from, as a list of
+       quads of 4 (x, y, z) corners in winding order. It clamps its loop indices in
+       place, which meshes the first inner layers twice'''
+    bin_array = np.fliplr(np.flipud(np.array(bin_array)))
+    x, y, z = bin_array.shape
+    x_max, y_max, z_max = x - 1, y - 1, z - 1
+    bin_array[0, :, :] = bin_array[:, 0, :] = bin_array[:, :, 0] = 0
+    bin_array[x_max, :, :] = bin_array[:, y_max, :] = bin_array[:, :, z_max] = 0
+    quads = []
+    for i in range(x):
+        for j in range(y):
+            for k in range(z):
+                current = bin_array[i, j, k]
+                i = min(max(i, 1), x_max - 1)
+                j = min(max(j, 1), y_max - 1)
+                k = min(max(k, 1), z_max - 1)
+                surrounding = [bin_array[i, j + 1, k], bin_array[i - 1, j, k], bin_array[i, j - 1, k],
+                               bin_array[i + 1, j, k], bin_array[i, j, k + 1], bin_array[i, j, k - 1]]
+                if current == 1:
+                    for num, nb in enumerate(surrounding):
+                        if nb == 0:
+                            corners = [(dx + 2 * k, dy + 2 * i, dz + 2 * j) for dx, dy, dz in FACE_OFFSETS[num]]
+                            quads.append(tuple(corners[n] for n in FACE_WINDING[num]))
+    return quads
+
+def mesh_quads(verts, faces):
+    '''(n, 4, 3) corners of every quad in winding order'''
+    return np.asarray(verts)[np.asarray(faces, dtype=np.int64)]
+
+def as_tuples(quads):
+    return [tuple(tuple(float(c) for c in corner) for corner in quad) for quad in quads]
+
+def random_grid(size, fill, seed):
+    return (np.random.RandomState(seed).uniform(size=(size,) * 3) < fill).astype(np.float32)
+
+def surface_stats(verts, faces):
+    '''total area and enclosed volume of a closed quad mesh in voxel units, the quads are
+       split into triangles like the viewer and the exporters do'''
+    quads = mesh_quads(verts, faces).astype(np.float64) / 2
+    area = np.linalg.norm(np.cross(quads[:, 2] - quads[:, 0], quads[:, 3] - quads[:, 1]), axis=1).sum() / 2
+    volume = 0.0
+    for a, b, c in ((0, 1, 2), (2, 3, 0)):
+        volume += np.einsum('ij,ij->i', quads[:, a], np.cross(quads[:, b], quads[:, c])).sum() / 6
+    return area, volume
+
+@pytest.mark.parametrize('size', [6, 9, 16])
+@pytest.mark.parametrize('fill', [0.3, 0.7])
+def test_mesh_arrays_matches_loop(size, fill):
+    grid = random_grid(size, fill, size)
+    expected = reference_quads(grid)
+    quads = as_tuples(mesh_quads(*tools.mesh_arrays(grid)))
+    assert len(set(quads)) == len(quads)
+    assert set(quads) == set(expected)
+
+def test_mesh_arrays_leaves_input_unchanged():
+    grid = random_grid(9, 0.5, 0)
+    grid[0] = grid[:, -1] = 1
+    before = grid.copy()
+    tools.mesh_arrays(grid)
+    tools.mesh_arrays(grid, greedy=True)
+    assert np.array_equal(grid, before)
+
+@pytest.mark.parametrize('greedy', [False, True])
+def test_chunks_and_greedy_keep_the_surface(greedy):
+    grid = random_grid(16, 0.6, 1)
+    grid[3:13, 3:13, 3:13] = 1
+    naive = tools.mesh_arrays(grid)
+    whole = tools.mesh_arrays(grid, greedy)
+    chunked = tools.join_chunks(tools.iter_mesh_chunks(grid, greedy, slab=3))
+    if not greedy:
+        assert sorted(as_tuples(mesh_quads(*chunked))) == sorted(as_tuples(mesh_quads(*naive)))
+    else:
+        # merged rectangles cover the same faces with fewer quads
+        assert len(whole[1]) < len(naive[1])
+    area, volume = surface_stats(*naive)
+    # interior voxels only, mesh_arrays clears the outer layer
+    assert volume == pytest.approx(np.count_nonzero(tools.solid_grid(grid)))
+    for mesh in (whole, chunked):
+        assert surface_stats(*mesh) == pytest.approx((area, volume))
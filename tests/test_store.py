@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+import store
+from store import ShapeStore
+
+def legacy_dir(tmp_path, amount=4, size=8):
+    '''a legacy shapes dir of shape{i}.npy files, returns the dir and the shapes'''
+    rng = np.random.RandomState(0)
+    shapes = [(rng.uniform(size=(size, size, size)) > 0.5).astype(np.float32) for _ in range(amount)]
+    for i, shape in enumerate(shapes):
+        np.save(str(tmp_path / 'shape{}.npy'.format(i)), shape)
+    return str(tmp_path), shapes
+
+def test_migrate_keeps_order(tmp_path):
+    dirname, shapes = legacy_dir(tmp_path)
+    opened = ShapeStore.open(dirname)
+    assert len(opened) == len(shapes)
+    for i, shape in enumerate(shapes):
+        assert np.array_equal(opened[i], shape)
+    assert store.legacy_files(dirname) == []
+    assert sorted(os.listdir(dirname)) == ['index.npy', 'shapes.bin']
+
+def test_interrupted_migration_starts_over(tmp_path, monkeypatch):
+    dirname, shapes = legacy_dir(tmp_path)
+    load = np.load
+    calls = []
+
+    def failing_load(path, *args, **kwargs):
+        calls.append(path)
+        if len(calls) > 2:
+            raise KeyboardInterrupt
+        return load(path, *args, **kwargs)
+
+    monkeypatch.setattr(np, 'load', failing_load)
+    with pytest.raises(KeyboardInterrupt):
+        ShapeStore.open(dirname)
+    monkeypatch.setattr(np, 'load', load)
+    assert len(store.legacy_files(dirname)) == len(shapes)
+
+    opened = ShapeStore.open(dirname)
+    assert len(opened) == len(shapes)
+    for i, shape in enumerate(shapes):
+        assert np.array_equal(opened[i], shape)
+    assert sorted(os.listdir(dirname)) == ['index.npy', 'shapes.bin']
+
+def test_failed_add_keeps_the_previous_index(tmp_path):
+    dirname = str(tmp_path)
+    with ShapeStore.create(dirname) as created:
+        created.add(np.ones((4, 4, 4)))
+    with pytest.raises(RuntimeError):
+        with ShapeStore.open(dirname) as opened:
+            opened.add(np.zeros((4, 4, 4)))
+            raise RuntimeError
+    assert len(ShapeStore.open(dirname)) == 1
+    # appending after the failure still indexes the right bits
+    with ShapeStore.open(dirname) as opened:
+        opened.add(np.zeros((4, 4, 4)))
+    reopened = ShapeStore.open(dirname)
+    assert len(reopened) == 2 and reopened[0].all() and not reopened[1].any()
@@ -1,492 +1,1081 @@
-import webbrowser
-import os
-import json
-import numpy as np
-from jinja2 import Template
-
-'''Tools for io, dataset handling, browser based 3D visualization, and numpy array to 3D mesh conversion'''
-
-def get_path(dirname, fname=''):
-    '''returns absolute path for file in a directory'''
-    #only works when called from same dir
-    abspath = os.path.dirname(__file__)
-    dirpath = os.path.join(abspath, dirname)
-    if not os.path.exists(dirpath):
-        os.mkdir(dirpath)
-    return os.path.join(dirpath, fname)
-
-def generate_coords(size):
-    '''input coords for nn, vector of [x, y, radius]'''
-    x = np.arange(0, size)
-    y = np.arange(0, size)
-    z = np.arange(0, size)
-    x_points, y_points, z_points = np.meshgrid(x, y, z)
-    center = size / 2
-    tmp = []
-    for i in range(x_points.shape[0]):
-        for j in range(y_points.shape[1]):
-            for k in range(z_points.shape[2]):
-                dx = x_points[i, j, k]
-                dy = y_points[i, j, k] 
-                dz = z_points[i, j, k] 
-                tmp.append([dx , dy , dz , np.sqrt((dx - center) ** 2 + (dy - center) ** 2 + (dz - center) ** 2)])
-
-    data = np.array(tmp, dtype=np.float32)
-    data_min, data_max = np.amin(data), np.amax(data)
-    normal = (data - data_min)  / (data_max - data_min) 
-    return normal
-
-def gen_coord_datasets():
-    '''Generate and save coordinate datasets for disk access.
-       Coordinate datasets are in powers of 2 sizes 8:256'''
-
-    if not os.path.exists('coord_datasets'):
-        for i in range(3, 9, 1):
-            size = 2 ** i
-            save_path = get_path('coord_datasets', 'data{}'.format(size))
-            data = generate_coords(size)
-            np.save(save_path, data)
-        print('datasets generated')
-    else:
-        print('datasets already generated')
-
-def load_coord_dataset(size):
-    data_path = get_path('coord_datasets', 'data{}.npy'.format(size))
-    return np.load(data_path)
-
-
-def np2vox(bin_array):
-    '''Convert binary numpy ndarray to indexed 3D mesh data'''
-    
-    def scale_verts(x, y, z, face_type):
-        x *= 2
-        y *= 2
-        z *= 2
-        verts = []
-
-        if face_type == 0: 
-            verts = [(0.0 + x, 2.0 + y, 2.0 + z),
-                     (0.0 + x, 0.0 + y, 2.0 + z),
-                     (2.0 + x, 2.0 + y, 2.0 + z),
-                     (2.0 + x, 0.0 + y, 2.0 + z)]
-
-        elif face_type == 1: 
-            verts = [(0.0 + x, 0.0 + y, 0.0 + z),
-                     (2.0 + x, 0.0 + y, 0.0 + z),
-                     (0.0 + x, 0.0 + y, 2.0 + z),               
-                     (2.0 + x, 0.0 + y, 2.0 + z)]
-
-        elif face_type == 2: 
-            verts = [(0.0 + x, 2.0 + y, 0.0 + z),
-                     (0.0 + x, 0.0 + y, 0.0 + z),
-                     (2.0 + x, 2.0 + y, 0.0 + z),
-                     (2.0 + x, 0.0 + y, 0.0 + z)]
-
-        elif face_type == 3: 
-            verts = [(0.0 + x, 2.0 + y, 0.0 + z),
-                     (2.0 + x, 2.0 + y, 0.0 + z),
-                     (0.0 + x, 2.0 + y, 2.0 + z),
-                     (2.0 + x, 2.0 + y, 2.0 + z)]
-
-        elif face_type == 4: 
-            verts = [(2.0 + x, 2.0 + y, 0.0 + z),
-                     (2.0 + x, 0.0 + y, 0.0 + z),
-                     (2.0 + x, 2.0 + y, 2.0 + z),
-                     (2.0 + x, 0.0 + y, 2.0 + z)]
-
-        elif face_type == 5: 
-            verts = [(0.0 + x, 2.0 + y, 0.0 + z),
-                     (0.0 + x, 0.0 + y, 0.0 + z),
-                     (0.0 + x, 2.0 + y, 2.0 + z),
-                     (0.0 + x, 0.0 + y, 2.0 + z)]
-        
-        return verts
-
-    def scale_faces(scale, face_type):
-
-        faces = np.array([[[0, 1, 3, 2]],
-                          [[0, 1, 3, 2]],
-                          [[1, 0, 2, 3]],
-                          [[1, 0, 2, 3]],
-                          [[1, 0, 2, 3]],
-                          [[0, 1, 3, 2]]])
-  
-        scaled_faces = faces[face_type] + 4 * scale
-        return scaled_faces.tolist()
-        
-    print('--> BUILDING MESH')
-    print('--> VOXEL VOLUME:', np.count_nonzero(bin_array))
-    bin_array = np.fliplr(np.flipud(bin_array))
-    verts = []
-    faces = []
-    x, y, z = bin_array.shape[0], bin_array.shape[1], bin_array.shape[2]
-    x_max, y_max, z_max = x - 1, y - 1, z - 1
-    count = 0
-    bin_array[0, :, :] = 0
-    bin_array[:, 0, :] = 0
-    bin_array[:, :, 0] = 0
-    bin_array[x_max, :, :] = 0
-    bin_array[:, y_max, :] = 0
-    bin_array[:, :, z_max] = 0
-        
-    for i in range(x): 
-        for j in range(y):
-            for k in range(z):
-                current = bin_array[i,j,k]
-                if i == x_max:
-                    i = x_max - 1
-                elif i == 0:
-                    i = 1
-                if j == y_max:
-                    j = y_max - 1
-                elif j == 0:
-                    j = 1
-                if k == z_max:
-                    k = z_max - 1 
-                elif k == 0:
-                    k = 1
-
-                surrounding = np.array([bin_array[i,j+1,k],    
-                                        bin_array[i-1,j,k], 
-                                        bin_array[i,j-1,k], 
-                                        bin_array[i+1,j,k], 
-                                        bin_array[i,j,k+1], 
-                                        bin_array[i,j,k-1]], dtype=int)
-                if current == 1:
-                    for num in range(len(surrounding)):
-                        if surrounding[num] == 0:
-                            verts += scale_verts(k, i, j, num)
-                            faces += scale_faces(count, num)
-                            count += 1
-    return verts, faces
-
-def render_voxels(voxels):
-    '''Render np array in the browser as a mesh using np2vox func and three.js lib'''
-    verts, faces = np2vox(voxels)
-    mesh_data = {'verts': verts, 'faces': faces}
-    json_mesh = json.dumps(mesh_data)
-
-    html = Template('''<html>
-            <head>
-                <title>Viewer</title>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, user-scalable=no, minimum-scale=1.0, maximum-scale=1.0">
-                <link rel="stylesheet" type="text/css" href="css/styles1.css"/>
-            </head>
-            <body>
-                <canvas id="canvas"></canvas>
-                <div id="top_panel"></div>
-                <div id="bottom_panel">  
-                </div>
-
-                <script src="js/three.min.js"></script>
-                <script src="js/OrbitControls.js"></script>
-              
-                <script>
-                    
-                    var renderer = new THREE.WebGLRenderer({canvas: document.getElementById('canvas'), antialias: true});
-                  
-                    var camera = new THREE.PerspectiveCamera(70, window.innerWidth / window.innerHeight, 0.1, 10000);
-                    var scene = new THREE.Scene();
-
-                    //renderer
-                    renderer.setClearColor(0x37373B); 
-                    renderer.setSize(window.innerWidth, window.innerHeight);
-                    renderer.setPixelRatio(window.devicePixelRatio);
-                    document.body.appendChild(renderer.domElement);
-                    
-                    //scene and camera setup
-                    camera.position.set(-200, 200, -200);
-                    camera.up = new THREE.Vector3(0, 1, 0);
-                    camera.lookAt(new THREE.Vector3(0, 0, 0))
-                    scene.add(camera);
-                
-                    //controls
-                    var controls = new THREE.OrbitControls(camera, renderer.domElement);
-                    controls.target.set( 0, 0, 0);
-                    controls.update();
-                    //controls.minDistance = 150;
-                    controls.maxDistance = 2000;
-                    controls.zoomSpeed = 0.5;
-                    controls.enablePan = true;
-                    controls.rotateSpeed = 0.5;
-
-                    //lights
-                    var light1 = new THREE.AmbientLight(0xffffff, 1.0);
-                    scene.add(light1);
-
-                    var light2 = new THREE.PointLight(0xff3333, 0.75);
-                    light2.position.set(100, 200, 500);
-                    scene.add(light2)
-                    var light4 = new THREE.PointLight(0x3333ff, 0.75);
-                    light2.position.set(-100, 200, -500);
-                    scene.add(light4)
-
-                    var light3 = new THREE.SpotLight(0xddddff, 1);
-                    light3.position.set(-300, -300, 300);
-                    scene.add(light3);
-
-                    window.addEventListener('resize',windowResize, false);
-
-                    function windowResize(){
-                        camera.aspect = window.innerWidth / window.innerHeight;
-                        camera.updateProjectionMatrix();
-                        renderer.setSize( window.innerWidth, window.innerHeight);
-                    }
-
-                    function render() {
-                        requestAnimationFrame(render);
-                        renderer.render(scene, camera);
-                    }
-
-                    var mesh_data = JSON.parse(JSON.stringify({{ data }}));
-                    console.log(mesh_data)
-                    var verts = mesh_data.verts;
-                    var faces = mesh_data.faces;
-                
-                    var geometry = new THREE.Geometry();
-
-                    for (i=0; i < verts.length; i++){
-                        geometry.vertices.push(new THREE.Vector3(verts[i][1], verts[i][2], verts[i][0]));
-                    }
-                    for (i=0; i < faces.length; i++){
-                        geometry.faces.push(new THREE.Face3(faces[i][0], faces[i][1], faces[i][2]));
-                        geometry.faces.push(new THREE.Face3(faces[i][2], faces[i][3], faces[i][0]));
-                    }
-                    console.log('computing normals');
-                    geometry.computeBoundingSphere();
-                    geometry.computeFaceNormals();
-                    geometry.computeVertexNormals();
-                    console.log('building scene');
-
-                    var material = new THREE.MeshLambertMaterial({
-
-                                color: 0x616c72,
-                            
-                                
-                    });
-                    var material1 = new THREE.MeshLambertMaterial({
-
-                                color: 0x000000,
-                                wireframe: true,
-                                transparent: true,
-                                opacity: 0.7,                                
-                    });
-                    
-                    
-                    var voxmesh = new THREE.Mesh(geometry, material);
-                    var voxmeshW = new THREE.Mesh(geometry, material1);
-                    var geo = new THREE.PlaneGeometry(200, 200);
-                    var mat = new THREE.MeshLambertMaterial({
-
-                                color: 0xe0e3e5,
-                                wireframe: false,
-                                transparent: true,
-                                opacity: 0.7,
-                                side: THREE.DoubleSide
-                                
-                    });
-                    var plane = new THREE.Mesh(geo, mat);
-                    plane.rotateX(Math.PI / 2);
-                    scene.add(plane);
-                    scene.add(voxmesh);
-                   // scene.add(voxmeshW);
-                    var x = {{x}};
-                    var y = {{y}};
-                    var z = {{z}};
-                    voxmesh.position.set(x, y, z);
-                    //voxmeshW.position.set(x, y, z);
-
-                    var cube_geo = new THREE.BoxGeometry(5, 5, 5);
-                    var cube_mat = new THREE.MeshLambertMaterial({ color: 0x442222});
-                    var cube = new THREE.Mesh(cube_geo, cube_mat);
-                    scene.add(cube);
-                    cube.position.set(-102.5, 0, -102.5);
-
-                    render();
-                </script>
-            </body>
-        </html>''')
-    
-    new_html = html.render(data=json_mesh, x=-voxels.shape[0], y=voxels.shape[1] / 2, z=-voxels.shape[2])
-    path = get_path('templates', 'template.html')
-    with open(path, 'w') as f:
-        f.write(new_html)
-    webbrowser.open(path, new=2)
-
-def render_voxel_ani(vox_list):
-    '''Render latent space traversal as animation.
-       Displays np array in the browser as a mesh using np2vox func and three.js lib'''    
-    verts_list = []
-    faces_list = []
-    for vox in vox_list:
-        # compute the mesh data for each voxel array
-        verts, faces = np2vox(vox)
-        verts_list.append(verts)
-        faces_list.append(faces)
-    # json version of list of mesh data
-    mesh_data = {'verts': verts_list, 'faces': faces_list}
-    json_meshes = json.dumps(mesh_data)
-    html = Template('''<html>
-            <head>
-                <title>Viewer</title>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, user-scalable=no, minimum-scale=1.0, maximum-scale=1.0">
-                <link rel="stylesheet" type="text/css" href="css/styles1.css"/>
-            </head>
-            <body>
-                <canvas id="canvas"></canvas>
-                <div id="top_panel"></div>
-                <div id="bottom_panel">  
-                </div>
-
-                <script src="js/three.min.js"></script>
-                <script src="js/OrbitControls.js"></script>
-              
-                <script>
-                    var renderer = new THREE.WebGLRenderer({canvas: document.getElementById('canvas'), antialias: true});
-                    var camera = new THREE.PerspectiveCamera(70, window.innerWidth / window.innerHeight, 0.1, 10000);
-                    var scene = new THREE.Scene();
-
-                    renderer.setClearColor(0x37373B); 
-                    renderer.setSize(window.innerWidth, window.innerHeight);
-                    renderer.setPixelRatio(window.devicePixelRatio);
-                    document.body.appendChild(renderer.domElement);
-                    
-                    //scene and camera setup
-                    camera.position.set(-200, 200, -200);
-                    camera.up = new THREE.Vector3(0, 1, 0);
-                    camera.lookAt(new THREE.Vector3(0, 0, 0))
-                    scene.add(camera);
-                
-                    //controls
-                    var controls = new THREE.OrbitControls(camera, renderer.domElement);
-                    controls.target.set( 0, 0, 0);
-                    controls.update();
-                    //controls.minDistance = 150;
-                    controls.maxDistance = 2000;
-                    controls.zoomSpeed = 0.5;
-                    controls.enablePan = true;
-                    controls.rotateSpeed = 0.5;
-
-                    //lights
-                    var light1 = new THREE.AmbientLight(0xffffff, 1.0);
-                    scene.add(light1);
-                    var light2 = new THREE.PointLight(0xff3333, 0.75);
-                    light2.position.set(100, 200, 500);
-                    scene.add(light2)
-                    var light4 = new THREE.PointLight(0x3333ff, 0.75);
-                    light2.position.set(-100, 200, -500);
-                    scene.add(light4)
-                    var light3 = new THREE.SpotLight(0xddddff, 1);
-                    light3.position.set(-300, -300, 300);
-                    scene.add(light3);
-
-                    window.addEventListener('resize',windowResize, false);
-
-                    function windowResize(){
-                        camera.aspect = window.innerWidth / window.innerHeight;
-                        camera.updateProjectionMatrix();
-                        renderer.setSize( window.innerWidth, window.innerHeight);
-                    }
-
-                    function render() {
-                        requestAnimationFrame(render);
-                        renderer.render(scene, camera);
-                    }
-
-                    var material = new THREE.MeshLambertMaterial({color: 0x616c72});
-                    var material1 = new THREE.MeshLambertMaterial({
-                                color: 0x000000,
-                                wireframe: true,
-                                transparent: true,
-                                opacity: 0.7,                                
-                    });
-
-                    var geo = new THREE.PlaneGeometry(200, 200);
-                    var mat = new THREE.MeshLambertMaterial({
-                                color: 0xe0e3e5,
-                                wireframe: false,
-                                transparent: true,
-                                opacity: 0.7,
-                                side: THREE.DoubleSide 
-                    });
-
-                    var plane = new THREE.Mesh(geo, mat);
-                    plane.rotateX(Math.PI / 2);
-                    scene.add(plane);
-                    var x = {{x}};
-                    var y = {{y}};
-                    var z = {{z}};
-                    var cube_geo = new THREE.BoxGeometry(5, 5, 5);
-                    var cube_mat = new THREE.MeshLambertMaterial({ color: 0x442222});
-                    var cube = new THREE.Mesh(cube_geo, cube_mat);
-                    scene.add(cube);
-                    cube.position.set(-102.5, 0, -102.5);
-                    
-                    // mesh
-                    var mesh_data = JSON.parse(JSON.stringify({{ mesh_list }}));
-                    var verts_list = mesh_data.verts;
-                    var faces_list = mesh_data.faces;
-
-                    for (j=0; j < verts_list.length; j++)
-                    {
-                        // build each object as a three js mesh
-                        verts = verts_list[j];
-                        faces = faces_list[j];
-                        
-                        var geometry = new THREE.Geometry();
-                        for (i=0; i < verts.length; i++){
-                            geometry.vertices.push(new THREE.Vector3(verts[i][1], verts[i][2], verts[i][0]));
-                        }
-                        for (i=0; i < faces.length; i++){
-                            geometry.faces.push(new THREE.Face3(faces[i][0], faces[i][1], faces[i][2]));
-                            geometry.faces.push(new THREE.Face3(faces[i][2], faces[i][3], faces[i][0]));
-                        }
-                        geometry.computeBoundingSphere();
-                        geometry.computeFaceNormals();
-                        geometry.computeVertexNormals();
-                        var voxmesh = new THREE.Mesh(geometry, material);
-                        voxmesh.name = 'mesh' + i.toString();
-                        voxmesh.visible = false;
-                        voxmesh.position.set(x, y, z);
-                        scene.add(voxmesh);
-                        console.log('built mesh');
-                    }
-
-                    var delay = {{ speed }};
-                    var i = 7;
-                    setInterval(function()
-                    {
-                        if (i == scene.children.length - 1){
-                            scene.children[i-1].visible = false;
-                            i = 7;
-                        } else {
-                            if (i != 7){
-                                scene.children[i-1].visible = false;
-                            }
-                            scene.children[i].visible = true;
-                            i++;
-                        }
-                    }, delay);
-
-                    render();
-                </script>
-            </body>
-        </html>''')
-
-    # animation speed line eq
-    x = [5, 20]
-    y = [75, 8]
-    c = np.polyfit(x, y, 1)
-    line = np.poly1d(c)
-    new_html = html.render(mesh_list=json_meshes, 
-                            x=-vox_list[0].shape[0], 
-                            y=vox_list[0].shape[1] / 2, 
-                            z=-vox_list[0].shape[2],
-                            speed=line(len(vox_list)) * len(vox_list))
-    
-    path = get_path('templates', 'template_ani.html')
-    with open(path, 'w') as f:
-        f.write(new_html)
-    webbrowser.open(path, new=2) 
\ No newline at end of file
+import webbrowser
+import os
+import json
+import base64
+import itertools
+import time
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from jinja2 import Template
+import instrument
+
+'''Tools for io, dataset handling, browser based 3D visualization, and numpy array to 3D mesh conversion'''
+
+def get_path(dirname, fname=''):
+    '''returns absolute path for file in a directory'''
+    #only works when called from same dir
+    abspath = os.path.dirname(__file__)
+    dirpath = os.path.join(abspath, dirname)
+    if not os.path.exists(dirpath):
+        os.mkdir(dirpath)
+    return os.path.join(dirpath, fname)
+
+def coord_bounds(size):
+    '''global min and max over all four coordinate columns, computed without building the grid'''
+    center = size / 2
+    axis = (np.arange(size) - center) ** 2
+    # sqrt is monotonic, so the radius extremes come from the per axis extremes
+    radius = np.array([np.sqrt(3 * axis.min()), np.sqrt(3 * axis.max())], dtype=np.float32)
+    data_min = min(np.float32(0), radius[0])
+    data_max = max(np.float32(size - 1), radius[1])
+    return data_min, data_max
+
+# bytes per voxel of the radius layer fill_coord_slab works in, a float64 plane and sum
+RADIUS_LAYER_BYTES = 16
+
+def fill_coord_slab(size, start, stop, out):
+    '''Write normalized coords for grid layers start:stop (slowest axis) into out.
+       out is a float32 array of shape ((stop - start) * size * size, 4). Besides out only
+       one layer of float64 radius temporaries is used, RADIUS_LAYER_BYTES per layer voxel'''
+    axis = np.arange(size)
+    layers = np.arange(start, stop)
+    center = size / 2
+    block = out.reshape(stop - start, size, size, 4)
+    # same layout as np.meshgrid(x, y, z) flattened in C order: row [i, j, k] -> [j, i, k, radius]
+    block[..., 0] = axis[None, :, None]
+    block[..., 1] = layers[:, None, None]
+    block[..., 2] = axis[None, None, :]
+    sq = (axis - center) ** 2
+    plane = sq[:, None] + sq[None, :]
+    radius = np.empty_like(plane)
+    for n, layer in enumerate(layers):
+        np.add(plane, (layer - center) ** 2, out=radius)
+        block[n, ..., 3] = np.sqrt(radius, out=radius)
+    data_min, data_max = coord_bounds(size)
+    out -= data_min
+    out /= data_max - data_min
+    return out
+
+def grid_coords(size, index):
+    '''normalized coords for (n, 3) grid indices (i, j, k), equal to the matching
+       generate_coords rows i * size * size + j * size + k'''
+    index = np.asarray(index)
+    center = size / 2
+    out = np.empty((len(index), 4), dtype=np.float32)
+    out[:, 0] = index[:, 1]
+    out[:, 1] = index[:, 0]
+    out[:, 2] = index[:, 2]
+    out[:, 3] = np.sqrt(((index - center) ** 2).sum(axis=1))
+    data_min, data_max = coord_bounds(size)
+    out -= data_min
+    out /= data_max - data_min
+    return out
+
+def iter_coord_slabs(size, slab=16):
+    '''yield (start, stop, coords) for chunks of slab grid layers, rows match generate_coords'''
+    for start in range(0, size, slab):
+        stop = min(start + slab, size)
+        out = np.empty(((stop - start) * size * size, 4), dtype=np.float32)
+        yield start, stop, fill_coord_slab(size, start, stop, out)
+
+def generate_coords(size, out=None, slab=16):
+    '''input coords for nn, vector of [x, y, z, radius]
+       min max normalized over all four columns. Built slab by slab straight into out,
+       a preallocated float32 array of shape (size ** 3, 4)'''
+    if out is None:
+        out = np.empty((size ** 3, 4), dtype=np.float32)
+    layer = size * size
+    for start in range(0, size, slab):
+        stop = min(start + slab, size)
+        fill_coord_slab(size, start, stop, out[start * layer:stop * layer])
+    return out
+
+# in process cache of opened coordinate datasets, size -> array, least recently used first
+COORD_CACHE = OrderedDict()
+# byte budget of the cache, the arrays are memory mapped so this bounds address space
+# and page cache use more than resident memory
+COORD_CACHE_BYTES = 512 * 2 ** 20
+
+def coord_dataset_path(size):
+    return get_path('coord_datasets', 'data{}.npy'.format(size))
+
+def save_coord_dataset(size):
+    '''Generate the coordinate dataset of size straight into a memory mapped .npy file.
+       Written under a temporary name and moved into place, so an interrupted run never
+       leaves a partial dataset behind'''
+    path = coord_dataset_path(size)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(size ** 3, 4))
+    generate_coords(size, out)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+    return path
+
+def gen_coord_datasets(sizes=(8, 16, 32, 64, 128, 256)):
+    '''Generate and save the coordinate datasets of sizes that are missing on disk.
+       load_coord_dataset builds any size on demand, this only prebuilds them'''
+    missing = [size for size in sizes if not os.path.exists(coord_dataset_path(size))]
+    for size in missing:
+        save_coord_dataset(size)
+    print('datasets generated: {}'.format(missing) if missing else 'datasets already generated')
+
+@instrument.timed('coords')
+def load_coord_dataset(size):
+    '''Read only, memory mapped (size ** 3, 4) coordinate dataset of any size, generated
+       and saved on first use. Opened datasets are kept in COORD_CACHE, least recently
+       used ones are dropped once the cache exceeds COORD_CACHE_BYTES'''
+    if size in COORD_CACHE:
+        COORD_CACHE.move_to_end(size)
+        return COORD_CACHE[size]
+    path = coord_dataset_path(size)
+    if not os.path.exists(path):
+        save_coord_dataset(size)
+    data = np.load(path, mmap_mode='r')
+    COORD_CACHE[size] = data
+    while len(COORD_CACHE) > 1 and sum(d.nbytes for d in COORD_CACHE.values()) > COORD_CACHE_BYTES:
+        COORD_CACHE.popitem(last=False)
+    return data
+
+
+# quad corners for each face type, in voxel units of 2 with vertices as (k, i, j)
+# face types: 0 j+, 1 i-, 2 j-, 3 i+, 4 k+, 5 k-
+FACE_CORNERS = np.array([[(0, 2, 2), (0, 0, 2), (2, 2, 2), (2, 0, 2)],
+                         [(0, 0, 0), (2, 0, 0), (0, 0, 2), (2, 0, 2)],
+                         [(0, 2, 0), (0, 0, 0), (2, 2, 0), (2, 0, 0)],
+                         [(0, 2, 0), (2, 2, 0), (0, 2, 2), (2, 2, 2)],
+                         [(2, 2, 0), (2, 0, 0), (2, 2, 2), (2, 0, 2)],
+                         [(0, 2, 0), (0, 0, 0), (0, 2, 2), (0, 0, 2)]], dtype=np.float32)
+
+# winding of the 4 quad corners for each face type
+FACE_ORDER = np.array([[0, 1, 3, 2],
+                       [0, 1, 3, 2],
+                       [1, 0, 2, 3],
+                       [1, 0, 2, 3],
+                       [1, 0, 2, 3],
+                       [0, 1, 3, 2]], dtype=np.uint32)
+
+def solid_grid(bin_array):
+    '''Boolean occupancy in mesh orientation: flipped on the first two axes with the
+       outer layer cleared. Always returns a new array'''
+    return solid_slab(bin_array, 0, len(bin_array))
+
+def solid_slab(bin_array, start, stop):
+    '''Layers start:stop of solid_grid(bin_array), only reading the bin_array layers
+       they come from, so bin_array can be a memory map or GridFile larger than memory'''
+    size = len(bin_array)
+    # the first axis is flipped, solid layer n is bin_array layer size - 1 - n
+    solid = np.fliplr(np.asarray(bin_array[size - stop:size - start])[::-1] == 1).copy()
+    if start == 0:
+        solid[0] = False
+    if stop == size:
+        solid[-1] = False
+    solid[:, [0, -1], :] = False
+    solid[:, :, [0, -1]] = False
+    return solid
+
+class GridFile:
+    '''Read only view of a (size, size, size) grid saved as .npy that supports len(),
+       .shape and first axis slices. Every slice maps only its own layers and copies
+       them out, so slab by slab readers such as iter_mesh_chunks keep just one slab of
+       a grid larger than memory resident'''
+
+    def __init__(self, path):
+        self.path = path
+        grid = np.load(path, mmap_mode='r')
+        self.shape, self.dtype, self.offset = grid.shape, grid.dtype, grid.offset
+        del grid
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.shape[0])
+        layer = int(np.prod(self.shape[1:]))
+        if stop <= start:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        block = np.memmap(self.path, self.dtype, 'r', self.offset + start * layer * self.dtype.itemsize,
+                          (stop - start,) + self.shape[1:])
+        layers = np.array(block[::step])
+        del block
+        return layers
+
+# bytes per voxel of a slab meshed by iter_mesh_chunks: the read and solid layers,
+# the exposed face mask and greedy merge temporaries
+SLAB_MESH_BYTES = 32
+# bytes per face of a mesh chunk while it is built and written: face indices, cells,
+# verts, quads and the exporters' copies of them
+MESH_FACE_BYTES = 512
+
+def slab_layers(size, budget, voxel_bytes, reserve=0):
+    '''grid layers per slab so a slab of size * size * voxel_bytes per layer, plus
+       reserve bytes, fits in budget bytes. Raises ValueError when not even one does'''
+    layer = size * size * voxel_bytes
+    layers = int((budget - reserve) // layer)
+    if layers < 1:
+        raise ValueError('a budget of {:0.1f} MB is too small for {}^3 slabs, one layer needs {:0.1f} MB'.format(
+                         budget / 2 ** 20, size, (reserve + layer) / 2 ** 20))
+    return layers
+
+def exposed_faces(solid):
+    '''Boolean mask (x - 2, y - 2, z - 2, 6) of exposed faces for the interior cells of a
+       solid grid from solid_grid, found by comparing shifted copies of the grid'''
+    core = solid[1:-1, 1:-1, 1:-1]
+    neighbours = (solid[1:-1, 2:, 1:-1],
+                  solid[:-2, 1:-1, 1:-1],
+                  solid[1:-1, :-2, 1:-1],
+                  solid[2:, 1:-1, 1:-1],
+                  solid[1:-1, 1:-1, 2:],
+                  solid[1:-1, 1:-1, :-2])
+    exposed = np.empty(core.shape + (6,), dtype=bool)
+    for num, nb in enumerate(neighbours):
+        np.greater(core, nb, out=exposed[..., num])
+    return exposed
+
+# cell axis (0 i, 1 j, 2 k) each face type points along
+FACE_NORMAL_AXIS = (1, 0, 1, 0, 2, 2)
+
+def faces_to_mesh(cells, face_type, extents=None):
+    '''Build quads for faces given as (n, 3) interior grid cells (i, j, k) and face types.
+       extents (n, 3) stretches each quad over that many cells per axis, default 1.
+       Returns float32 verts (4n, 3) and uint32 faces (n, 4)'''
+    cells = np.asarray(cells)
+    offset = np.empty((len(cells), 3), dtype=np.float32)
+    offset[:, 0] = cells[:, 2]
+    offset[:, 1] = cells[:, 0]
+    offset[:, 2] = cells[:, 1]
+    corners = FACE_CORNERS[face_type]
+    if extents is not None:
+        extents = np.asarray(extents)
+        scale = np.empty((len(cells), 3), dtype=np.float32)
+        scale[:, 0] = extents[:, 2]
+        scale[:, 1] = extents[:, 0]
+        scale[:, 2] = extents[:, 1]
+        corners = corners * scale[:, None, :]
+    verts = corners + 2 * offset[:, None, :]
+    instrument.count('faces emitted', len(cells))
+    faces = FACE_ORDER[face_type] + 4 * np.arange(len(cells), dtype=np.uint32)[:, None]
+    return np.ascontiguousarray(verts.reshape(-1, 3)), np.ascontiguousarray(faces)
+
+def merge_faces(exposed):
+    '''Greedily merge coplanar exposed faces of the same type into rectangles.
+       Faces are joined into runs along one in plane axis, then identical runs in
+       neighbouring rows are stacked along the other. Returns interior cells (n, 3),
+       extents (n, 3) and face types (n,)'''
+    cells, extents, types = [], [], []
+    for face_type in range(6):
+        normal = FACE_NORMAL_AXIS[face_type]
+        merge_axis, run_axis = [a for a in range(3) if a != normal]
+        mask = exposed[..., face_type].transpose(normal, merge_axis, run_axis)
+        edges = np.zeros(mask.shape[:2] + (mask.shape[2] + 1,), dtype=np.int8)
+        edges[..., 1:] = mask
+        edges[..., :-1] -= mask
+        # run starts and ends come out paired since nonzero walks in C order
+        plane, row, start = np.nonzero(edges == -1)
+        end = np.nonzero(edges == 1)[2]
+        if len(plane) == 0:
+            continue
+        order = np.lexsort((row, end, start, plane))
+        plane, row, start, end = plane[order], row[order], start[order], end[order]
+        new_rect = np.ones(len(plane), dtype=bool)
+        new_rect[1:] = ((plane[1:] != plane[:-1]) | (start[1:] != start[:-1]) |
+                        (end[1:] != end[:-1]) | (row[1:] != row[:-1] + 1))
+        first = np.flatnonzero(new_rect)
+        height = np.diff(np.append(first, len(plane)))
+        rect_cells = np.empty((len(first), 3), dtype=np.int64)
+        rect_cells[:, normal] = plane[first]
+        rect_cells[:, merge_axis] = row[first]
+        rect_cells[:, run_axis] = start[first]
+        rect_extents = np.ones((len(first), 3), dtype=np.int64)
+        rect_extents[:, merge_axis] = height
+        rect_extents[:, run_axis] = end[first] - start[first]
+        cells.append(rect_cells)
+        extents.append(rect_extents)
+        types.append(np.full(len(first), face_type))
+    if not cells:
+        return np.zeros((0, 3), dtype=np.int64), np.ones((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(cells), np.concatenate(extents), np.concatenate(types)
+
+# the 8 cube corners of a cell and its 12 edges as corner pairs, for surface_nets
+CUBE_CORNERS = np.array([(a, b, c) for a in (0, 1) for b in (0, 1) for c in (0, 1)])
+CUBE_EDGES = [(p, q) for p in range(8) for q in range(p + 1, 8)
+              if np.abs(CUBE_CORNERS[p] - CUBE_CORNERS[q]).sum() == 1]
+
+@instrument.timed('mesh')
+def surface_nets(field, level=0.5):
+    '''Smooth quad mesh of the level iso-surface of a continuous (x, y, z) field, such
+       as the network's probabilities, by naive surface nets (a dual contouring variant).
+       Every cell of 8 samples crossing the level gets one vertex at the mean of its
+       interpolated edge crossings, and every sample edge crossing the level gets a quad
+       joining the 4 cells around it. Only cells crossing the surface are processed.
+       Samples sit at voxel centers in the same orientation as mesh_arrays, the outer
+       layer is treated as outside so surfaces are closed.
+       Returns float32 verts (n, 3) and uint32 faces (m, 4) like mesh_arrays'''
+    f = np.fliplr(np.flipud(np.asarray(field, dtype=np.float32))).copy()
+    f[[0, -1], :, :] = f[:, [0, -1], :] = f[:, :, [0, -1]] = min(0, level - 1)
+    inside = f > level
+    cells = tuple(n - 1 for n in f.shape)
+    any_in = np.zeros(cells, dtype=bool)
+    all_in = np.ones(cells, dtype=bool)
+    for a, b, c in CUBE_CORNERS:
+        corner = inside[a:a + cells[0], b:b + cells[1], c:c + cells[2]]
+        any_in |= corner
+        all_in &= corner
+    active = np.flatnonzero(any_in & ~all_in)
+    del any_in, all_in
+    if not len(active):
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 4), dtype=np.uint32)
+    index = np.stack(np.unravel_index(active, cells), axis=1)
+
+    # vertex per active cell, mean of the edge crossings
+    values = np.stack([f[index[:, 0] + a, index[:, 1] + b, index[:, 2] + c] for a, b, c in CUBE_CORNERS], axis=1)
+    total = np.zeros((len(active), 3), dtype=np.float32)
+    crossings = np.zeros(len(active), dtype=np.float32)
+    for p, q in CUBE_EDGES:
+        v0, v1 = values[:, p], values[:, q]
+        cross = (v0 > level) != (v1 > level)
+        t = np.where(cross, (level - v0) / np.where(cross, v1 - v0, 1), 0)
+        total += cross[:, None] * (CUBE_CORNERS[p] + t[:, None] * (CUBE_CORNERS[q] - CUBE_CORNERS[p]))
+        crossings += cross
+    points = index + total / crossings[:, None]
+    # to the mesh_arrays vertex space: (k, i, j) in units of 2, samples at voxel centers
+    verts = np.ascontiguousarray((2 * points[:, [2, 0, 1]] + 1).astype(np.float32))
+
+    # a quad around every interior sample edge that crosses the level
+    faces = []
+    for axis in range(3):
+        u, v = [a for a in range(3) if a != axis]
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        start_in = inside[tuple(lo)]
+        change = start_in != inside[tuple(hi)]
+        # the 4 cells around an edge need it away from the u and v borders
+        border = [slice(None)] * 3
+        border[u] = border[v] = slice(1, -1)
+        edges = np.argwhere(change[tuple(border)])
+        edges[:, u] += 1
+        edges[:, v] += 1
+        step_u = np.zeros(3, dtype=np.int64)
+        step_v = np.zeros(3, dtype=np.int64)
+        step_u[u] = step_v[v] = 1
+        around = [edges, edges - step_u, edges - step_u - step_v, edges - step_v]
+        quad = np.stack([np.searchsorted(active, np.ravel_multi_index(c.T, cells)) for c in around], axis=1)
+        # wind every quad so it faces from inside to outside
+        flip = start_in[tuple(edges.T)] == (axis == 1)
+        quad[flip] = quad[flip][:, ::-1]
+        faces.append(quad)
+    faces = np.ascontiguousarray(np.concatenate(faces).astype(np.uint32))
+    instrument.count('faces emitted', len(faces))
+    return verts, faces
+
+def mesh_grid(grid, greedy=False, level=None):
+    '''blocky mesh_arrays of a binary grid, or the surface_nets iso-surface at level
+       of a probability grid when a level is given'''
+    if level is None:
+        return mesh_arrays(grid, greedy)
+    return surface_nets(grid, level)
+
+@instrument.timed('mesh')
+def mesh_arrays(bin_array, greedy=False):
+    '''Vectorized face culling mesher. Same faces as the original per voxel loop, without
+       modifying bin_array. With greedy, coplanar neighbouring faces are merged into
+       rectangles. Returns contiguous float32 verts (4n, 3) and uint32 faces (n, 4)'''
+    exposed = exposed_faces(solid_grid(bin_array))
+    if greedy:
+        cells, extents, face_type = merge_faces(exposed)
+        return faces_to_mesh(cells + 1, face_type, extents)
+    i, j, k, face_type = np.nonzero(exposed)
+    cells = np.stack([i, j, k], axis=1) + 1
+    return faces_to_mesh(cells, face_type)
+
+def face_blocks(counts, max_faces):
+    '''Split a slab with (layers, rows) exposed face counts into (layer start, layer stop,
+       row start, row stop) blocks of at most max_faces faces. Runs of whole layers are
+       taken while they fit, a layer with more faces is split by rows, and only a row
+       with more than max_faces faces on its own makes a larger block'''
+    per_layer = counts.sum(axis=1)
+    start = 0
+    while start < len(counts):
+        stop, total = start, 0
+        while stop < len(counts) and total + per_layer[stop] <= max_faces:
+            total += per_layer[stop]
+            stop += 1
+        if stop > start:
+            yield start, stop, 0, counts.shape[1]
+            start = stop
+            continue
+        row, rows = 0, counts[start]
+        while row < len(rows):
+            end, total = row + 1, rows[row]
+            while end < len(rows) and total + rows[end] <= max_faces:
+                total += rows[end]
+                end += 1
+            yield start, start + 1, row, end
+            row = end
+        start += 1
+
+def iter_mesh_chunks(bin_array, greedy=False, slab=32, max_faces=None):
+    '''Mesh bin_array slab interior layers (first axis of the solid grid) at a time,
+       yielding float32 verts (4n, 3) and uint32 faces (n, 4) per slab, faces indexing
+       the slab's own verts. Each slab sees one extra layer on both sides, so its faces
+       are the same as mesh_arrays. With max_faces a slab is yielded in blocks of at most
+       that many faces, see face_blocks, so dense surfaces such as a checkerboard stay
+       bounded too. Greedy rectangles do not cross slab or block boundaries.
+       Only those slab + 2 layers are read at a time, see solid_slab'''
+    size = len(bin_array)
+    for lo in range(1, size - 1, slab):
+        hi = min(lo + slab, size - 1)
+        exposed = exposed_faces(solid_slab(bin_array, lo - 1, hi + 1))
+        if max_faces is None:
+            blocks = [(0, len(exposed), 0, exposed.shape[1])]
+        else:
+            blocks = face_blocks(np.count_nonzero(exposed, axis=(2, 3)), max_faces)
+        for start, stop, row_start, row_stop in blocks:
+            block = exposed[start:stop, row_start:row_stop]
+            if greedy:
+                cells, extents, face_type = merge_faces(block)
+            else:
+                i, j, k, face_type = np.nonzero(block)
+                cells, extents = np.stack([i, j, k], axis=1), None
+            if len(face_type):
+                yield faces_to_mesh(cells + (lo + start, row_start + 1, 1), face_type, extents)
+
+def join_chunks(chunks):
+    '''one (verts, faces) mesh of (verts, faces) chunks with chunk local indices'''
+    verts, faces, offset = [], [], 0
+    for chunk_verts, chunk_faces in chunks:
+        verts.append(chunk_verts)
+        faces.append(chunk_faces + np.uint32(offset))
+        offset += len(chunk_verts)
+    if not verts:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 4), dtype=np.uint32)
+    return np.concatenate(verts), np.concatenate(faces)
+
+def mesh_voxels(bin_array, greedy=False, level=None):
+    '''Convert binary numpy ndarray to indexed 3D mesh arrays, printing mesh stats.
+       With a level, bin_array is a probability grid meshed smooth, see mesh_grid'''
+    print('--> BUILDING MESH')
+    print('--> VOXEL VOLUME:', np.count_nonzero(bin_array if level is None else bin_array > level))
+    verts, faces = mesh_grid(bin_array, greedy, level)
+    print('--> FACES:', len(faces))
+    return verts, faces
+
+def np2vox(bin_array, greedy=False):
+    '''Convert binary numpy ndarray to indexed 3D mesh data'''
+    verts, faces = mesh_voxels(bin_array, greedy)
+    return verts.tolist(), faces.tolist()
+
+def compare_meshers(bin_array):
+    '''Print face count and time of the naive and greedy meshers side by side'''
+    report = {}
+    for name, greedy in (('naive', False), ('greedy', True)):
+        start = time.time()
+        verts, faces = mesh_arrays(bin_array, greedy)
+        report[name] = {'faces': len(faces), 'time': time.time() - start}
+    size = 'x'.join(str(s) for s in np.shape(bin_array))
+    ratio = report['naive']['faces'] / max(report['greedy']['faces'], 1)
+    print('--> MESHERS {}: naive {} faces {:0.3f}s | greedy {} faces {:0.3f}s | {:0.1f}x fewer faces'.format(
+          size, report['naive']['faces'], report['naive']['time'],
+          report['greedy']['faces'], report['greedy']['time'], ratio))
+    return report
+
+# neighbour step (i, j, k) in the solid grid each face type looks at
+FACE_STEPS = np.array([(0, 1, 0), (-1, 0, 0), (0, -1, 0), (1, 0, 0), (0, 0, 1), (0, 0, -1)])
+
+class FrameMesher:
+    '''Incremental naive mesher for a sequence of similar frames, e.g. a latent traversal.
+       Keeps the previous frame's solid grid and exposed face mask; on update only the
+       cells around flipped voxels are re-examined. Faces are identified by
+       id = flat interior cell index * 6 + face type, as in np.nonzero(exposed).
+       Frames with more than full_ratio of their voxels flipped are recomputed in full
+
+       mesher = FrameMesher()
+       for vox in frames:
+           added, removed = mesher.update(vox)'''
+
+    def __init__(self, full_ratio=0.125):
+        self.full_ratio = full_ratio
+        self.solid = None
+        self.exposed = None
+
+    def update(self, bin_array):
+        '''move to the next frame, returns the sorted face ids added and removed'''
+        solid = solid_grid(bin_array)
+        if self.solid is None or solid.shape != self.solid.shape:
+            self.solid, self.exposed = solid, exposed_faces(solid)
+            return np.flatnonzero(self.exposed), np.zeros(0, dtype=np.int64)
+        flipped = np.argwhere(solid != self.solid)
+        self.solid = solid
+        if len(flipped) > self.full_ratio * solid.size:
+            exposed = exposed_faces(solid)
+            changed = exposed != self.exposed
+            added = np.flatnonzero(changed & exposed)
+            removed = np.flatnonzero(changed & self.exposed)
+            self.exposed = exposed
+            return added, removed
+        # flipped cells and their 6 neighbours, as interior cell indices
+        inner = np.array(self.exposed.shape[:3])
+        cells = (flipped[:, None, :] + np.vstack([(0, 0, 0), FACE_STEPS])[None]).reshape(-1, 3) - 1
+        cells = cells[np.all((cells >= 0) & (cells < inner), axis=1)]
+        cells = np.unravel_index(np.unique(np.ravel_multi_index(cells.T, inner)), inner)
+        core = solid[cells[0] + 1, cells[1] + 1, cells[2] + 1]
+        exposed = np.empty((len(core), 6), dtype=bool)
+        for face_type, (di, dj, dk) in enumerate(FACE_STEPS):
+            nb = solid[cells[0] + 1 + di, cells[1] + 1 + dj, cells[2] + 1 + dk]
+            np.greater(core, nb, out=exposed[:, face_type])
+        old = self.exposed[cells]
+        self.exposed[cells] = exposed
+        ids = np.ravel_multi_index(cells, inner)[:, None] * 6 + np.arange(6)
+        return ids[exposed & ~old], ids[old & ~exposed]
+
+    def faces(self, ids):
+        '''verts (4n, 3) and faces (n, 4) for face ids, as faces_to_mesh'''
+        cell, face_type = np.divmod(np.asarray(ids, dtype=np.int64), 6)
+        cells = np.stack(np.unravel_index(cell, self.exposed.shape[:3]), axis=1) + 1
+        return faces_to_mesh(cells, face_type)
+
+    def mesh(self):
+        '''full mesh of the current frame, equal to mesh_arrays(frame)'''
+        return self.faces(np.flatnonzero(self.exposed))
+
+def mesh_buffers(verts, faces):
+    '''Viewer ready buffers: float32 positions in three.js axis order and a flat
+       uint32 triangle index, two triangles per quad'''
+    positions = np.ascontiguousarray(np.asarray(verts, dtype=np.float32)[:, [1, 2, 0]])
+    index = np.ascontiguousarray(np.asarray(faces, dtype=np.uint32)[:, [0, 1, 2, 2, 3, 0]]).ravel()
+    return positions, index
+
+def delta_frames(vox_iter):
+    '''Generator of delta animation frames for js/voxmesh.js, meshed with a FrameMesher.
+       Every face that appears during the animation gets a slot of 4 verts in winding
+       order, stored once in the frame it first appears. Each frame holds the verts of
+       its new slots and the slot ids that are shown (add) and hidden (remove) compared
+       to the previous frame. Yields (buffers, face count)'''
+    mesher = FrameMesher()
+    # face ids with a slot, sorted, and their slot numbers
+    known = np.zeros(0, dtype=np.int64)
+    slots = np.zeros(0, dtype=np.int64)
+    for vox in vox_iter:
+        added, removed = mesher.update(vox)
+        pos = np.minimum(np.searchsorted(known, added), max(len(known) - 1, 0))
+        found = known[pos] == added if len(known) else np.zeros(len(added), dtype=bool)
+        new = added[~found]
+        new_slots = np.arange(len(slots), len(slots) + len(new))
+        verts, faces = mesher.faces(new)
+        positions = np.ascontiguousarray(verts[faces.ravel()][:, [1, 2, 0]])
+        buffers = {'verts': positions,
+                   'add': np.concatenate([slots[pos[found]], new_slots]).astype(np.uint32),
+                   'remove': slots[np.searchsorted(known, removed)].astype(np.uint32)}
+        known = np.concatenate([known, new])
+        slots = np.concatenate([slots, new_slots])
+        order = np.argsort(known, kind='stable')
+        known, slots = known[order], slots[order]
+        yield buffers, int(np.count_nonzero(mesher.exposed))
+
+def encode_frame(verts, faces, payload='base64', bin_file=None, offset=0):
+    '''Encode one mesh as a payload frame dict read by js/voxmesh.js.
+       payload: base64 | bin | json. The bin format writes the buffers to the open
+       bin_file at byte offset and only stores [offset, count] pairs.
+       Returns the frame and the number of bytes written to bin_file'''
+    return encode_buffers(dict(zip(('verts', 'index'), mesh_buffers(verts, faces))),
+                          payload, bin_file, offset)
+
+def encode_buffers(buffers, payload='base64', bin_file=None, offset=0):
+    '''encode a dict of named numpy buffers as a payload frame, see encode_frame'''
+    frame = {}
+    written = 0
+    for name, buf in buffers.items():
+        data = buf.astype(buf.dtype.newbyteorder('<')).tobytes()
+        if payload == 'json':
+            frame[name] = buf.ravel().tolist()
+        elif payload == 'base64':
+            frame[name] = base64.b64encode(data).decode('ascii')
+        elif payload == 'bin':
+            bin_file.write(data)
+            frame[name] = [offset + written, buf.size]
+            written += len(data)
+        else:
+            raise ValueError('unknown payload format: {}'.format(payload))
+    return frame, written
+
+def encode_meshes(meshes, payload='base64', bin_path=None):
+    '''Encode a list of (verts, faces) meshes as the payload dict read by js/voxmesh.js.
+       payload: base64 | bin | json. The bin format writes all buffers to bin_path
+       and only stores offsets in the dict'''
+    frames = []
+    bin_file = open(bin_path, 'wb') if payload == 'bin' else None
+    offset = 0
+    try:
+        for verts, faces in meshes:
+            frame, written = encode_frame(verts, faces, payload, bin_file, offset)
+            frames.append(frame)
+            offset += written
+    finally:
+        if bin_file is not None:
+            bin_file.close()
+    data = {'format': payload, 'frames': frames}
+    if payload == 'bin':
+        data['bin'] = os.path.basename(bin_path)
+    return data
+
+@instrument.timed('serialize')
+def serialize_buffers(buffers, payload='base64'):
+    '''Frame encoding that does not depend on the output file: the json text of the frame
+       for base64 and json payloads, (name, little endian bytes, count) tuples for bin'''
+    if payload != 'bin':
+        return json.dumps(encode_buffers(buffers, payload)[0])
+    return [(name, buf.astype(buf.dtype.newbyteorder('<')).tobytes(), buf.size)
+            for name, buf in buffers.items()]
+
+def mesh_frame_job(vox, greedy=False, payload='base64', level=None):
+    '''Mesh and serialize one animation frame, run in a worker process.
+       Returns the encoded frame, its face count, the worker pid and the time taken'''
+    start = time.time()
+    verts, faces = mesh_grid(vox, greedy, level)
+    encoded = serialize_buffers(dict(zip(('verts', 'index'), mesh_buffers(verts, faces))), payload)
+    return encoded, len(faces), os.getpid(), time.time() - start
+
+def iter_frame_jobs(vox_iter, greedy=False, payload='base64', workers=2, level=None):
+    '''Mesh and serialize frames on a process pool, yielding mesh_frame_job results in
+       frame order. At most 2 * workers frames are in flight, so a frame generator is
+       still only pulled as fast as frames are written'''
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for vox in vox_iter:
+            # binary frames, 4x smaller to send than float32, probability frames as they are
+            vox = np.asarray(vox) == 1 if level is None else np.asarray(vox, dtype=np.float32)
+            pending.append(pool.submit(mesh_frame_job, vox, greedy, payload, level))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class ViewerWriter:
+    '''Streams mesh frames into a viewer page under templates/ as they are added, so
+       only the current frame is held in memory. The page template defines a js
+       show(payload, ...) function which close() calls from an appended script block.
+       Prints the output size and the python side encode and write time on close,
+       frames encoded in other processes only count their write'''
+
+    def __init__(self, html, fname, payload='base64', delta=False, **params):
+        if payload not in ('base64', 'bin', 'json'):
+            raise ValueError('unknown payload format: {}'.format(payload))
+        start = time.time()
+        self.fname = fname
+        self.payload = payload
+        self.path = get_path('templates', fname)
+        self.bin_path = os.path.splitext(self.path)[0] + '.bin'
+        self.frames = 0
+        self.offset = 0
+        self.file = open(self.path, 'w')
+        self.bin_file = open(self.bin_path, 'wb') if payload == 'bin' else None
+        self.file.write(html.render(**params))
+        header = {'format': payload}
+        if delta:
+            header['delta'] = True
+        if payload == 'bin':
+            header['bin'] = os.path.basename(self.bin_path)
+        # open the payload object, frames are appended one by one
+        self.file.write('<script>show({}, "frames": ['.format(json.dumps(header)[:-1]))
+        self.time = time.time() - start
+
+    def add(self, verts, faces):
+        '''encode and write one frame'''
+        start = time.time()
+        buffers = dict(zip(('verts', 'index'), mesh_buffers(verts, faces)))
+        self.time += time.time() - start
+        self.add_buffers(buffers)
+
+    def add_buffers(self, buffers):
+        '''encode and write one frame of named buffers, e.g. a delta frame'''
+        start = time.time()
+        encoded = serialize_buffers(buffers, self.payload)
+        self.time += time.time() - start
+        self.add_encoded(encoded)
+
+    @instrument.timed('write')
+    def add_encoded(self, encoded):
+        '''write one frame already encoded by serialize_buffers, e.g. in another process'''
+        start = time.time()
+        if self.payload == 'bin':
+            frame = {}
+            for name, data, count in encoded:
+                self.bin_file.write(data)
+                frame[name] = [self.offset, count]
+                self.offset += len(data)
+            encoded = json.dumps(frame)
+        if self.frames:
+            self.file.write(', ')
+        self.file.write(encoded)
+        self.frames += 1
+        self.time += time.time() - start
+
+    def close(self, *args):
+        '''finish the page, extra args are passed on to the js show function'''
+        start = time.time()
+        self.file.write(']}')
+        for arg in args:
+            self.file.write(', ' + json.dumps(float(arg)))
+        self.file.write(');</script>\n            </body>\n        </html>')
+        self.file.close()
+        nbytes = os.path.getsize(self.path)
+        if self.bin_file is not None:
+            self.bin_file.close()
+            nbytes += os.path.getsize(self.bin_path)
+        instrument.count('bytes written', nbytes)
+        self.time += time.time() - start
+        print('--> WROTE {} ({} payload, {} frames): {} bytes in {:0.3f}s'.format(
+              self.fname, self.payload, self.frames, nbytes, self.time))
+        return self.path
+
+def write_viewer(html, meshes, fname, payload='base64', args=(), **params):
+    '''Write a viewer page for a list of (verts, faces) meshes into templates/fname,
+       args are numbers passed on to the js show function'''
+    writer = ViewerWriter(html, fname, payload, **params)
+    for verts, faces in meshes:
+        writer.add(verts, faces)
+    return writer.close(*args)
+
+def compare_payloads(meshes):
+    '''Print encoded size and python side encode time of the legacy json lists and the
+       typed buffer payload formats, without writing the viewer'''
+    report = {}
+    start = time.time()
+    legacy = json.dumps({'verts': [np.asarray(v).tolist() for v, f in meshes],
+                         'faces': [np.asarray(f).tolist() for v, f in meshes]})
+    report['legacy json'] = {'bytes': len(legacy), 'time': time.time() - start}
+    for payload in ('json', 'base64', 'bin'):
+        start = time.time()
+        bin_path = get_path('templates', 'payload_compare.bin')
+        text = json.dumps(encode_meshes(meshes, payload, bin_path))
+        nbytes = len(text)
+        if payload == 'bin':
+            nbytes += os.path.getsize(bin_path)
+            os.remove(bin_path)
+        report[payload] = {'bytes': nbytes, 'time': time.time() - start}
+    for name, stats in report.items():
+        print('--> PAYLOAD {:>11}: {:>12} bytes {:0.3f}s'.format(name, stats['bytes'], stats['time']))
+    return report
+
+VIEWER_HTML = Template('''<html>
+            <head>
+                <title>Viewer</title>
+                <meta charset="utf-8">
+                <meta name="viewport" content="width=device-width, user-scalable=no, minimum-scale=1.0, maximum-scale=1.0">
+                <link rel="stylesheet" type="text/css" href="css/styles1.css"/>
+            </head>
+            <body>
+                <canvas id="canvas"></canvas>
+                <div id="top_panel"></div>
+                <div id="bottom_panel">  
+                </div>
+
+                <script src="js/three.min.js"></script>
+                <script src="js/OrbitControls.js"></script>
+                <script src="js/voxmesh.js"></script>
+              
+                <script>
+                    
+                    var renderer = new THREE.WebGLRenderer({canvas: document.getElementById('canvas'), antialias: true});
+                  
+                    var camera = new THREE.PerspectiveCamera(70, window.innerWidth / window.innerHeight, 0.1, 10000);
+                    var scene = new THREE.Scene();
+
+                    //renderer
+                    renderer.setClearColor(0x37373B); 
+                    renderer.setSize(window.innerWidth, window.innerHeight);
+                    renderer.setPixelRatio(window.devicePixelRatio);
+                    document.body.appendChild(renderer.domElement);
+                    
+                    //scene and camera setup
+                    camera.position.set(-200, 200, -200);
+                    camera.up = new THREE.Vector3(0, 1, 0);
+                    camera.lookAt(new THREE.Vector3(0, 0, 0))
+                    scene.add(camera);
+                
+                    //controls
+                    var controls = new THREE.OrbitControls(camera, renderer.domElement);
+                    controls.target.set( 0, 0, 0);
+                    controls.update();
+                    //controls.minDistance = 150;
+                    controls.maxDistance = 2000;
+                    controls.zoomSpeed = 0.5;
+                    controls.enablePan = true;
+                    controls.rotateSpeed = 0.5;
+
+                    //lights
+                    var light1 = new THREE.AmbientLight(0xffffff, 1.0);
+                    scene.add(light1);
+
+                    var light2 = new THREE.PointLight(0xff3333, 0.75);
+                    light2.position.set(100, 200, 500);
+                    scene.add(light2)
+                    var light4 = new THREE.PointLight(0x3333ff, 0.75);
+                    light2.position.set(-100, 200, -500);
+                    scene.add(light4)
+
+                    var light3 = new THREE.SpotLight(0xddddff, 1);
+                    light3.position.set(-300, -300, 300);
+                    scene.add(light3);
+
+                    window.addEventListener('resize',windowResize, false);
+
+                    function windowResize(){
+                        camera.aspect = window.innerWidth / window.innerHeight;
+                        camera.updateProjectionMatrix();
+                        renderer.setSize( window.innerWidth, window.innerHeight);
+                    }
+
+                    function render() {
+                        requestAnimationFrame(render);
+                        renderer.render(scene, camera);
+                    }
+
+                    var material = new THREE.MeshLambertMaterial({
+
+                                color: 0x616c72,
+                            
+                                
+                    });
+                    var material1 = new THREE.MeshLambertMaterial({
+
+                                color: 0x000000,
+                                wireframe: true,
+                                transparent: true,
+                                opacity: 0.7,                                
+                    });
+                    
+                    
+                    var geo = new THREE.PlaneGeometry(200, 200);
+                    var mat = new THREE.MeshLambertMaterial({
+
+                                color: 0xe0e3e5,
+                                wireframe: false,
+                                transparent: true,
+                                opacity: 0.7,
+                                side: THREE.DoubleSide
+                                
+                    });
+                    var plane = new THREE.Mesh(geo, mat);
+                    plane.rotateX(Math.PI / 2);
+                    scene.add(plane);
+                    var x = {{x}};
+                    var y = {{y}};
+                    var z = {{z}};
+
+                    // called with the mesh payload appended by ViewerWriter
+                    function show(payload){
+                        VoxMesh.load(payload, function(geometries){
+                            console.log('building scene');
+                            var voxmesh = new THREE.Mesh(geometries[0], material);
+                            var voxmeshW = new THREE.Mesh(geometries[0], material1);
+                            scene.add(voxmesh);
+                           // scene.add(voxmeshW);
+                            voxmesh.position.set(x, y, z);
+                            //voxmeshW.position.set(x, y, z);
+                        });
+                    }
+
+                    var cube_geo = new THREE.BoxGeometry(5, 5, 5);
+                    var cube_mat = new THREE.MeshLambertMaterial({ color: 0x442222});
+                    var cube = new THREE.Mesh(cube_geo, cube_mat);
+                    scene.add(cube);
+                    cube.position.set(-102.5, 0, -102.5);
+
+                    render();
+                </script>
+''')
+
+def render_voxels(voxels, greedy=False, payload='base64', mesh=None, level=None):
+    '''Render np array in the browser as a mesh using mesh_voxels func and three.js lib.
+       payload: base64 | bin | json, see encode_meshes. mesh is an already built
+       (verts, faces) of voxels, e.g. from a GridCache. With a level, voxels is a
+       probability grid rendered as its smooth iso-surface'''
+    verts, faces = mesh_voxels(voxels, greedy, level) if mesh is None else mesh
+    path = write_viewer(VIEWER_HTML, [(verts, faces)], 'template.html', payload,
+                        x=-voxels.shape[0], y=voxels.shape[1] / 2, z=-voxels.shape[2])
+    webbrowser.open(path, new=2)
+
+ANIMATION_HTML = Template('''<html>
+            <head>
+                <title>Viewer</title>
+                <meta charset="utf-8">
+                <meta name="viewport" content="width=device-width, user-scalable=no, minimum-scale=1.0, maximum-scale=1.0">
+                <link rel="stylesheet" type="text/css" href="css/styles1.css"/>
+            </head>
+            <body>
+                <canvas id="canvas"></canvas>
+                <div id="top_panel"></div>
+                <div id="bottom_panel">  
+                </div>
+
+                <script src="js/three.min.js"></script>
+                <script src="js/OrbitControls.js"></script>
+                <script src="js/voxmesh.js"></script>
+              
+                <script>
+                    var renderer = new THREE.WebGLRenderer({canvas: document.getElementById('canvas'), antialias: true});
+                    var camera = new THREE.PerspectiveCamera(70, window.innerWidth / window.innerHeight, 0.1, 10000);
+                    var scene = new THREE.Scene();
+
+                    renderer.setClearColor(0x37373B); 
+                    renderer.setSize(window.innerWidth, window.innerHeight);
+                    renderer.setPixelRatio(window.devicePixelRatio);
+                    document.body.appendChild(renderer.domElement);
+                    
+                    //scene and camera setup
+                    camera.position.set(-200, 200, -200);
+                    camera.up = new THREE.Vector3(0, 1, 0);
+                    camera.lookAt(new THREE.Vector3(0, 0, 0))
+                    scene.add(camera);
+                
+                    //controls
+                    var controls = new THREE.OrbitControls(camera, renderer.domElement);
+                    controls.target.set( 0, 0, 0);
+                    controls.update();
+                    //controls.minDistance = 150;
+                    controls.maxDistance = 2000;
+                    controls.zoomSpeed = 0.5;
+                    controls.enablePan = true;
+                    controls.rotateSpeed = 0.5;
+
+                    //lights
+                    var light1 = new THREE.AmbientLight(0xffffff, 1.0);
+                    scene.add(light1);
+                    var light2 = new THREE.PointLight(0xff3333, 0.75);
+                    light2.position.set(100, 200, 500);
+                    scene.add(light2)
+                    var light4 = new THREE.PointLight(0x3333ff, 0.75);
+                    light2.position.set(-100, 200, -500);
+                    scene.add(light4)
+                    var light3 = new THREE.SpotLight(0xddddff, 1);
+                    light3.position.set(-300, -300, 300);
+                    scene.add(light3);
+
+                    window.addEventListener('resize',windowResize, false);
+
+                    function windowResize(){
+                        camera.aspect = window.innerWidth / window.innerHeight;
+                        camera.updateProjectionMatrix();
+                        renderer.setSize( window.innerWidth, window.innerHeight);
+                    }
+
+                    function render() {
+                        requestAnimationFrame(render);
+                        renderer.render(scene, camera);
+                    }
+
+                    var material = new THREE.MeshLambertMaterial({color: 0x616c72});
+                    var material1 = new THREE.MeshLambertMaterial({
+                                color: 0x000000,
+                                wireframe: true,
+                                transparent: true,
+                                opacity: 0.7,                                
+                    });
+
+                    var geo = new THREE.PlaneGeometry(200, 200);
+                    var mat = new THREE.MeshLambertMaterial({
+                                color: 0xe0e3e5,
+                                wireframe: false,
+                                transparent: true,
+                                opacity: 0.7,
+                                side: THREE.DoubleSide 
+                    });
+
+                    var plane = new THREE.Mesh(geo, mat);
+                    plane.rotateX(Math.PI / 2);
+                    scene.add(plane);
+                    var x = {{x}};
+                    var y = {{y}};
+                    var z = {{z}};
+                    var cube_geo = new THREE.BoxGeometry(5, 5, 5);
+                    var cube_mat = new THREE.MeshLambertMaterial({ color: 0x442222});
+                    var cube = new THREE.Mesh(cube_geo, cube_mat);
+                    scene.add(cube);
+                    cube.position.set(-102.5, 0, -102.5);
+                    
+                    // mesh, called with the payload appended by ViewerWriter
+                    function show(payload, delay){
+                        VoxMesh.load(payload, function(geometries){
+                            var meshes = [];
+                            for (j=0; j < geometries.length; j++)
+                            {
+                                // build each object as a three js mesh
+                                var voxmesh = new THREE.Mesh(geometries[j], material);
+                                voxmesh.name = 'mesh' + j.toString();
+                                voxmesh.visible = false;
+                                voxmesh.position.set(x, y, z);
+                                scene.add(voxmesh);
+                                meshes.push(voxmesh);
+                            }
+                            console.log('built meshes');
+
+                            var i = 0;
+                            setInterval(function()
+                            {
+                                meshes[(i + meshes.length - 1) % meshes.length].visible = false;
+                                meshes[i].visible = true;
+                                i = (i + 1) % meshes.length;
+                            }, delay);
+                        });
+                    }
+
+                    render();
+                </script>
+''')
+
+def iter_meshes(vox_iter, greedy=False, level=None):
+    '''mesh voxel grids one at a time as they are pulled from vox_iter'''
+    for vox in vox_iter:
+        yield mesh_voxels(vox, greedy, level)
+
+def render_voxel_ani(vox_list, greedy=False, payload='base64', delta=False, workers=None, level=None):
+    '''Render latent space traversal as animation.
+       Displays np array in the browser as a mesh using mesh_voxels func and three.js lib.
+       vox_list can be any iterable such as a generator of frames, each frame is meshed,
+       written to the page and dropped before the next one is pulled.
+       payload: base64 | bin | json, see encode_meshes.
+       With delta, frames are meshed incrementally and only their face changes are
+       written, see delta_frames. greedy is ignored then.
+       With workers > 1, frames are meshed and serialized on that many processes and
+       written in order, with a per worker timing report. Delta frames depend on the
+       previous frame, so they are always meshed in this process.
+       With a level, frames are probability grids meshed smooth, delta is not used then'''    
+    delta = delta and level is None
+    frames = iter(vox_list)
+    first = next(frames)
+    writer = ViewerWriter(ANIMATION_HTML, 'template_ani.html', payload, delta,
+                          x=-first.shape[0], 
+                          y=first.shape[1] / 2, 
+                          z=-first.shape[2])
+    frames = itertools.chain([first], frames)
+    del first
+    if delta:
+        for buffers, faces in delta_frames(frames):
+            print('--> DELTA FRAME: {} faces, +{} -{}'.format(faces, len(buffers['add']), len(buffers['remove'])))
+            writer.add_buffers(buffers)
+    elif workers is not None and workers > 1:
+        start = time.time()
+        busy = {}
+        for encoded, faces, pid, elapsed in iter_frame_jobs(frames, greedy, payload, workers, level):
+            print('--> FRAME {}: {} faces'.format(writer.frames, faces))
+            writer.add_encoded(encoded)
+            count, total = busy.get(pid, (0, 0))
+            busy[pid] = (count + 1, total + elapsed)
+        for pid, (count, total) in sorted(busy.items()):
+            print('--> WORKER {}: {} frames {:0.3f}s'.format(pid, count, total))
+        print('--> MESHED {} frames on {} workers in {:0.3f}s'.format(writer.frames, workers, time.time() - start))
+    else:
+        for verts, faces in iter_meshes(frames, greedy, level):
+            writer.add(verts, faces)
+
+    # animation speed line eq
+    x = [5, 20]
+    y = [75, 8]
+    c = np.polyfit(x, y, 1)
+    line = np.poly1d(c)
+    path = writer.close(line(writer.frames) * writer.frames)
+    webbrowser.open(path, new=2)